@@ -88,6 +88,24 @@ def parse_arguments(parser):
                           help=textwrap.dedent("""
                           Bioseq read chunk size. Default: 10000. """ ).strip())
     
+    optional.add_argument('--h5_chunk_size', type=int, metavar='INT', default=1, 
+                          help=textwrap.dedent("""
+                          Number of sites per HDF5 chunk. Use 1 for data read in 
+                          random order (training), and larger values for data read 
+                          in order (validation/prediction). Default: 1. """ ).strip())
+    
+    optional.add_argument('--compression', type=str, metavar='STR', default=H5_COMPRESSION_DEFAULT, choices=list(H5_COMPRESSION),
+                          help=textwrap.dedent("""
+                          Compression of HDF5 datasets: 'gzip', 'lzf' (faster to 
+                          read) or 'none'. Default: '{}'. """ ).strip().format(H5_COMPRESSION_DEFAULT))
+    
+    optional.add_argument('--seq_codes', default=False, action='store_true',  
+                          help=textwrap.dedent("""
+                          Store distal sequences as uint8 base codes instead of 
+                          float32 one-hot encoding. Only for distal_order 1; 
+                          bigWig tracks are not stored. Default: False.
+                          """).strip())
+    
     optional.add_argument('--out_format', type=str, metavar='STR', default='h5',  
                           help=textwrap.dedent("""
                           Generate HDF5 ('h5').
@@ -138,6 +156,13 @@ def main():
     n_files = args.n_files
 
     chunk_size = args.chunk_size
+    seq_codes = args.seq_codes
+    h5_chunk_size = args.h5_chunk_size
+    compression = args.compression
+    
+    if seq_codes and (distal_order != 1 or distal_binsize != 1):
+        print('Error: --seq_codes requires distal_order 1 and distal_binsize 1', file=sys.stderr)
+        sys.exit(1)
     
     start_time = time.time()
     print('Start time:', datetime.datetime.now())
@@ -160,11 +185,17 @@ def main():
             print('Warnings: no bigWig files provided in', bw_paths)
     else:
         print('NOTE: no bigWig files provided.')
+    
+    if seq_codes and len(bw_files) > 0:
+        print('NOTE: --seq_codes was set, so bigWig tracks will not be stored!')
+        bw_paths = None
+        bw_files = []
+        bw_names = []
 
     if i_file == 0:
         if n_files == 1:
-            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
-            generate_h5f(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
+            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order, seq_codes)
+            generate_h5f(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_size, chunk_size, seq_codes=seq_codes, compression=compression)
             #generate_h5fv2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
 
         elif n_files > 1:
@@ -180,17 +211,21 @@ def main():
                          '--i_file', str(i+1), 
                          '--n_files', str(n_files), 
                          '--chunk_size', str(chunk_size),
-                         '--distal_binsize', str(distal_binsize)]
+                         '--distal_binsize', str(distal_binsize),
+                         '--h5_chunk_size', str(h5_chunk_size),
+                         '--compression', compression]
                 if bw_paths != None:
                     args.append('--bw_paths')
                     args.append(bw_paths)
+                if seq_codes:
+                    args.append('--seq_codes')
                 #'--bw_paths', bw_paths, 
                 p = subprocess.Popen(args)
                 ps.append(p)
             for p in ps:
                 p.wait()
             
-            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
+            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order, seq_codes)
             
             with h5py.File(h5f_path, 'w') as hf:
                 for i in  range(n_files):
@@ -205,15 +240,15 @@ def main():
 
             
     else:
-        h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
+        h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order, seq_codes)
         single_size = int(np.ceil(len(test_bed)/float(n_files)))
         h5f_path_i = re.sub('h5$', str(i_file)+'.h5', h5f_path)
         bed_regions = BedTool(test_bed.at(range((i_file-1)*single_size,np.min([i_file*single_size, len(test_bed)]))))
         
         if distal_binsize == 1:
-            generate_h5f_singlev1(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, bw_files, chunk_size)
+            generate_h5f_singlev1(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, bw_files, chunk_size, seq_codes=seq_codes, h5_chunk_size=h5_chunk_size, compression=compression)
         else:
-            generate_h5f_singlev2(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, distal_binsize, bw_files, chunk_size)
+            generate_h5f_singlev2(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, distal_binsize, bw_files, chunk_size, h5_chunk_size=h5_chunk_size, compression=compression)
     
     #test_bed.at(range(single_size, bed_end))
     
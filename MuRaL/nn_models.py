@@ -1,9 +1,9 @@
 import sys
 import math
+import contextlib
 import random
 import gzip
 import pandas as pd
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -16,6 +16,54 @@ from scipy.special import lambertw
 from MuRaL.nn_utils import *
 from MuRaL.evaluation import *
 
+def autocast_context(device_type, dtype):
+    """Return an autocast context for the given dtype, or a no-op context if dtype is None"""
+    if dtype is None:
+        # Don't use torch.autocast(enabled=False), which would disable an outer autocast
+        return contextlib.nullcontext()
+    
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+def log_mean_softmax(a, b, log_softmax=True):
+    """
+    Log of the mean of two probability distributions, computed in the log domain
+    
+    Args:
+        a, b: logits (or log-probabilities if log_softmax is False), shape: batch_size, n_class
+        log_softmax: whether to apply log_softmax to the inputs first
+    """
+    if log_softmax:
+        a = F.log_softmax(a, dim=1)
+        b = F.log_softmax(b, dim=1)
+    
+    return torch.logaddexp(a, b) - math.log(2)
+
+def distal_branch_forward(x, conv1, maxpool1, RBs1, maxpool2, conv2, RBs2, maxpool3, conv3, fc):
+    """
+    Forward pass of a distal CNN branch (conv/ResBlocks/maxpool stages followed by FC layers)
+    
+    Args:
+        x: distal input, shape: batch_size, in_channels, L_in (lenth of sequence)
+        conv1, maxpool1, RBs1, maxpool2, conv2, RBs2, maxpool3, conv3, fc: layers of the branch
+    """
+    out = conv1(x) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
+    jump_input = out = maxpool1(out)
+
+    out = RBs1(out)    
+    out = out + jump_input.narrow(2, 0, out.size(2))    
+    out = maxpool2(out)
+
+    jump_input = out = conv2(out)    
+    out = RBs2(out)
+    out = out + jump_input.narrow(2, 0, out.size(2))
+    out = maxpool3(out)
+
+    out = conv3(out)
+    # Global max pooling over the sequence; amax() doesn't compute the argmax indices
+    out = out.amax(dim=2)
+    
+    return fc(out)
+
 class FeedForwardNN(nn.Module):
     """Feedforward only model with local data"""
 
@@ -72,9 +120,10 @@ class FeedForwardNN(nn.Module):
             cat_data: categorical seq data
         """
         if self.no_of_embs != 0:
-            local_out = [self.emb_layer(cat_data[:, i]) for i in range(self.no_of_cat)]
+            # One lookup for all columns, as they share the same embedding layer
+            # Embeddings are kept per position (not pooled with EmbeddingBag), as the position of each base matters
+            local_out = self.emb_layer(cat_data).reshape(cat_data.size(0), self.no_of_cat * 5) #x.shape: batch_size * sum(emb_size)
             
-        local_out = torch.cat(local_out, dim = 1) #x.shape: batch_size * sum(emb_size)
         local_out = self.emb_dropout_layer(local_out)
 
         if self.no_of_cont != 0:
@@ -110,7 +159,7 @@ class Network0(nn.Module):
     
 class Network1(nn.Module):
     """The expanded-only model"""
-    def __init__(self,  in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class):
+    def __init__(self,  in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, share_distal_cnn=False):
         """  
         Args:
             emb_dims: embedding dimensions
@@ -126,6 +175,7 @@ class Network1(nn.Module):
             distal_fc_dropout: dropout for distal fc layer
             n_class: number of classes (labels)
             emb_padding_idx: number to be used for padding in embeddings
+            share_distal_cnn: whether the two distal branches share their convolutional layers
         """
         
         super(Network1, self).__init__()
@@ -134,6 +184,13 @@ class Network1(nn.Module):
         
         self.kernel_size = kernel_size
         self.seq_len = distal_radius*2+1 - (distal_order-1)
+        assert self.seq_len > 200, "Error: distal seq len must be >200bp"
+        
+        # Start of the central 201bp used by the branch with smaller pooling sizes
+        self._center_offset = self.seq_len//2 - 100
+        
+        # dtype for autocast (e.g. torch.bfloat16) of the forward pass; None for FP32
+        self.amp_dtype = None
         
 
         rb1_kernel_size = 3
@@ -220,6 +277,10 @@ class Network1(nn.Module):
             #nn.ReLU(),
             
         )
+        
+        if share_distal_cnn:
+            # Use the same convolutional layers for both branches; only the pooling sizes, input lengths and FC layers differ
+            self.conv1_2, self.RBs1_2, self.conv2_2, self.RBs2_2, self.conv3_2 = self.conv1, self.RBs1, self.conv2, self.RBs2, self.conv3
            
     
     def forward(self, local_input, distal_input):
@@ -230,65 +291,54 @@ class Network1(nn.Module):
             local_input: local input
             distal_input: distal input
         """
-        
-        # CNN layers for distal_input
-        # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        assert distal_input.shape[2] > 200, "Error: distal seq len must be >200bp"
-        
-        distal_input0 = distal_input[:,:,(distal_input.shape[2]//2-100):(distal_input.shape[2]//2+100+1)].detach().clone()
-        distal_out = self.conv1(distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
-        jump_input = distal_out = self.maxpool1(distal_out)
-        
-        distal_out = self.RBs1(distal_out)    
-        assert(jump_input.shape[2] >= distal_out.shape[2])
-        distal_out = distal_out + jump_input[:,:,0:distal_out.shape[2]]    
-        distal_out = self.maxpool2(distal_out)
-        
-        jump_input = distal_out = self.conv2(distal_out)    
-        distal_out = self.RBs2(distal_out)
-        assert(jump_input.shape[2] >= distal_out.shape[2])
-        distal_out = distal_out + jump_input[:,:,0:distal_out.shape[2]]
-        distal_out = self.maxpool3(distal_out)
-        
-        distal_out = self.conv3(distal_out)
-        distal_out, _ = torch.max(distal_out, dim=2)
-        
 
-        distal_out = self.distal_fc1(distal_out)
-##############################
-        # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        distal_out2 = self.conv1_2(distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
-        jump_input2 = distal_out2 = self.maxpool1_2(distal_out2)
-        
-        distal_out2 = self.RBs1_2(distal_out2)    
-        assert(jump_input2.shape[2] >= distal_out2.shape[2])
-        distal_out2 = distal_out2 + jump_input2[:,:,0:distal_out2.shape[2]]    
-        distal_out2 = self.maxpool2_2(distal_out2)
-        
-        jump_input2 = distal_out2 = self.conv2_2(distal_out2)    
-        distal_out2 = self.RBs2_2(distal_out2)
-        assert(jump_input2.shape[2] >= distal_out2.shape[2])
-        distal_out2 = distal_out2 + jump_input2[:,:,0:distal_out2.shape[2]]
-        distal_out2 = self.maxpool3_2(distal_out2)
+        with autocast_context(distal_input.device.type, self.amp_dtype):
         
-        distal_out2 = self.conv3_2(distal_out2)
-        distal_out2, _ = torch.max(distal_out2, dim=2)
+            # CNN layers for distal_input
+            # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
+            # The branch with smaller pooling sizes uses the central 201bp
+            center_offset = self._center_offset if distal_input.size(2) == self.seq_len else distal_input.size(2)//2 - 100
+            distal_input0 = distal_input.narrow(2, center_offset, 201)
+            distal_out = distal_branch_forward(distal_input0, self.conv1, self.maxpool1, self.RBs1, self.maxpool2, self.conv2, self.RBs2, self.maxpool3, self.conv3, self.distal_fc1)
         
 
-        distal_out2 = self.distal_fc2(distal_out2)
+##############################
+            distal_out2 = distal_branch_forward(distal_input, self.conv1_2, self.maxpool1_2, self.RBs1_2, self.maxpool2_2, self.conv2_2, self.RBs2_2, self.maxpool3_2, self.conv3_2, self.distal_fc2)
 
 ##############################
         
+        # Average the two branches in FP32 for numerical stability
+        distal_out = distal_out.float()
+        distal_out2 = distal_out2.float()
+        
         #distal_out = torch.log((F.softmax(mid_out1, dim=1) +F.softmax(mid_out2, dim=1) + F.softmax(distal_out, dim=1))/3)
-        distal_out = torch.log(torch.clamp((F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2, min=1e-9))
+        #distal_out = torch.log(torch.clamp((F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2, min=1e-9))
+        distal_out = log_mean_softmax(distal_out, distal_out2)
          
         
         return distal_out
+
+    def fuse_for_eval(self):
+        """Fold BatchNorm layers into adjacent convolutions for faster prediction (eval mode only)"""
+        assert not self.training, 'fuse_for_eval() should be called after model.eval()'
+        
+        fused = {} # keep layers shared between the branches shared
+        for name in ['conv1', 'conv2', 'conv3', 'conv1_2', 'conv2_2', 'conv3_2']:
+            layers = getattr(self, name)
+            if id(layers) not in fused:
+                fused[id(layers)] = fuse_bn_conv_layers(layers)
+            setattr(self, name, fused[id(layers)])
+        
+        for m in self.modules():
+            if isinstance(m, ResBlock):
+                m.fuse_for_eval()
+        
+        return self
     
     
 class Network2(nn.Module):
     """Combined model with FeedForward and ResNet componets"""
-    def __init__(self,  emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx=None):
+    def __init__(self,  emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx=None, share_distal_cnn=False):
         """  
         Args:
             emb_dims: embedding dimensions
@@ -304,6 +354,7 @@ class Network2(nn.Module):
             distal_fc_dropout: dropout for distal fc layer
             n_class: number of classes (labels)
             emb_padding_idx: number to be used for padding in embeddings
+            share_distal_cnn: whether the two distal branches share their convolutional layers
         """
         
         super(Network2, self).__init__()
@@ -338,6 +389,13 @@ class Network2(nn.Module):
         
         self.kernel_size = kernel_size
         self.seq_len = distal_radius*2+1 - (distal_order-1)
+        assert self.seq_len > 200, "Error: distal seq len must be >200bp"
+        
+        # Start of the central 201bp used by the branch with smaller pooling sizes
+        self._center_offset = self.seq_len//2 - 100
+        
+        # dtype for autocast (e.g. torch.bfloat16) of the forward pass; None for FP32
+        self.amp_dtype = None
         
 
         rb1_kernel_size = 3
@@ -427,6 +485,10 @@ class Network2(nn.Module):
             
         )
         
+        if share_distal_cnn:
+            # Use the same convolutional layers for both branches; only the pooling sizes, input lengths and FC layers differ
+            self.conv1_2, self.RBs1_2, self.conv2_2, self.RBs2_2, self.conv3_2 = self.conv1, self.RBs1, self.conv2, self.RBs2, self.conv3
+        
         # Local FC layers
         self.local_fc = nn.Sequential(
             #nn.BatchNorm1d(lin_layer_sizes[-1]),
@@ -442,90 +504,80 @@ class Network2(nn.Module):
             local_input: local input
             distal_input: distal input
         """
-        
-        # FeedForward layers for local input
-        cont_data, cat_data = local_input
-        
-        if self.no_of_embs != 0:
-            local_out = [self.emb_layer(cat_data[:, i]) for i in range(self.no_of_cat)]
-            
-        local_out = torch.cat(local_out, dim = 1) #x.shape: batch_size * sum(emb_size)
-        local_out = self.emb_dropout_layer(local_out)
-
-        if self.no_of_cont != 0:
-            normalized_cont_data = self.first_bn_layer(cont_data)
 
-            if self.no_of_embs != 0:
-                local_out = torch.cat([local_out, normalized_cont_data], dim = 1) 
-            else:
-                local_out = normalized_cont_data
+        with autocast_context(distal_input.device.type, self.amp_dtype):
         
-        for lin_layer, dropout_layer, bn_layer in zip(self.lin_layers, self.droput_layers, self.bn_layers):
-            local_out = F.relu(lin_layer(local_out))
-            local_out = bn_layer(local_out)
-            local_out = dropout_layer(local_out)
+            # FeedForward layers for local input
+            cont_data, cat_data = local_input
         
-        assert distal_input.shape[2] > 200, "Error: distal seq len must be >200"
-        # CNN layers for distal_input
-        # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        distal_input0 = distal_input[:,:,(distal_input.shape[2]//2-100):(distal_input.shape[2]//2+100+1)].detach().clone()
-        distal_out = self.conv1(distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
-        jump_input = distal_out = self.maxpool1(distal_out)
-        
-        distal_out = self.RBs1(distal_out)    
-        assert(jump_input.shape[2] >= distal_out.shape[2])
-        distal_out = distal_out + jump_input[:,:,0:distal_out.shape[2]]    
-        distal_out = self.maxpool2(distal_out)
-        
-        jump_input = distal_out = self.conv2(distal_out)    
-        distal_out = self.RBs2(distal_out)
-        assert(jump_input.shape[2] >= distal_out.shape[2])
-        distal_out = distal_out + jump_input[:,:,0:distal_out.shape[2]]
-        distal_out = self.maxpool3(distal_out)
-        
-        distal_out = self.conv3(distal_out)
-        distal_out, _ = torch.max(distal_out, dim=2)
-        
-        # Separate FC layers 
-        local_out = self.local_fc(local_out)
-        distal_out = self.distal_fc1(distal_out)
+            if self.no_of_embs != 0:
+                # One lookup for all columns, as they share the same embedding layer
+                # Embeddings are kept per position (not pooled with EmbeddingBag), as the position of each base matters
+                local_out = self.emb_layer(cat_data).reshape(cat_data.size(0), self.no_of_cat * 5) #x.shape: batch_size * sum(emb_size)
+            
+            local_out = self.emb_dropout_layer(local_out)
+
+            if self.no_of_cont != 0:
+                normalized_cont_data = self.first_bn_layer(cont_data)
+
+                if self.no_of_embs != 0:
+                    local_out = torch.cat([local_out, normalized_cont_data], dim = 1) 
+                else:
+                    local_out = normalized_cont_data
+        
+            for lin_layer, dropout_layer, bn_layer in zip(self.lin_layers, self.droput_layers, self.bn_layers):
+                local_out = F.relu(lin_layer(local_out))
+                local_out = bn_layer(local_out)
+                local_out = dropout_layer(local_out)
+        
+            # CNN layers for distal_input
+            # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
+            # The branch with smaller pooling sizes uses the central 201bp
+            center_offset = self._center_offset if distal_input.size(2) == self.seq_len else distal_input.size(2)//2 - 100
+            distal_input0 = distal_input.narrow(2, center_offset, 201)
+            distal_out = distal_branch_forward(distal_input0, self.conv1, self.maxpool1, self.RBs1, self.maxpool2, self.conv2, self.RBs2, self.maxpool3, self.conv3, self.distal_fc1)
+        
+            # Separate FC layers 
+            local_out = self.local_fc(local_out)
 ##############################
-        # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        distal_out2 = self.conv1_2(distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
-        jump_input2 = distal_out2 = self.maxpool1_2(distal_out2)
-        
-        distal_out2 = self.RBs1_2(distal_out2)    
-        assert(jump_input2.shape[2] >= distal_out2.shape[2])
-        distal_out2 = distal_out2 + jump_input2[:,:,0:distal_out2.shape[2]]    
-        distal_out2 = self.maxpool2_2(distal_out2)
-        
-        jump_input2 = distal_out2 = self.conv2_2(distal_out2)    
-        distal_out2 = self.RBs2_2(distal_out2)
-        assert(jump_input2.shape[2] >= distal_out2.shape[2])
-        distal_out2 = distal_out2 + jump_input2[:,:,0:distal_out2.shape[2]]
-        distal_out2 = self.maxpool3_2(distal_out2)
-        
-        distal_out2 = self.conv3_2(distal_out2)
-        distal_out2, _ = torch.max(distal_out2, dim=2)
-        
-
-        distal_out2 = self.distal_fc2(distal_out2)
+            distal_out2 = distal_branch_forward(distal_input, self.conv1_2, self.maxpool1_2, self.RBs1_2, self.maxpool2_2, self.conv2_2, self.RBs2_2, self.maxpool3_2, self.conv3_2, self.distal_fc2)
 
 ##############################
         
+        # Average the three outputs in FP32 for numerical stability
+        local_out = local_out.float()
+        distal_out = distal_out.float()
+        distal_out2 = distal_out2.float()
+        
         #distal_out = torch.log((F.softmax(mid_out1, dim=1) +F.softmax(mid_out2, dim=1) + F.softmax(distal_out, dim=1))/3)
         #distal_out = torch.log((F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2)
-        distal_out = (F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2
-        local_out = F.softmax(local_out, dim=1)
+        #distal_out = (F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2
+        #local_out = F.softmax(local_out, dim=1)
+        # Mean of the two distal softmaxes and then mean with the local softmax (i.e. weights 1/4, 1/4, 1/2), in the log domain
+        distal_out = log_mean_softmax(distal_out, distal_out2)
+        local_out = F.log_softmax(local_out, dim=1)
         
-        if self.training == False and np.random.uniform(0,1) < 0.00001*local_out.shape[0]:
-            print('local_out1:', torch.min(local_out[:,1]).item(), torch.max(local_out[:,1]).item(), torch.var(local_out[:,1]).item())
-            print('distal_out1:', torch.min(distal_out[:,1]).item(), torch.max(distal_out[:,1]).item(),torch.var(distal_out[:,1]).item())
+        #out = torch.log(torch.clamp((local_out + distal_out)/2, min=1e-9))  
+        out = log_mean_softmax(local_out, distal_out, log_softmax=False)
+        
+        return out
 
+    def fuse_for_eval(self):
+        """Fold BatchNorm layers into adjacent convolutions for faster prediction (eval mode only)"""
+        assert not self.training, 'fuse_for_eval() should be called after model.eval()'
         
-        out = torch.log(torch.clamp((local_out + distal_out)/2, min=1e-9))  
+        fused = {} # keep layers shared between the branches shared
+        for name in ['conv1', 'conv2', 'conv3', 'conv1_2', 'conv2_2', 'conv3_2']:
+            layers = getattr(self, name)
+            if id(layers) not in fused:
+                fused[id(layers)] = fuse_bn_conv_layers(layers)
+            setattr(self, name, fused[id(layers)])
         
-        return out
+        for m in self.modules():
+            if isinstance(m, ResBlock):
+                m.fuse_for_eval()
+        
+        return self
     
 # Residual block (according to Jaganathan et al. 2019 Cell)
 class ResBlock(nn.Module):
@@ -538,15 +590,26 @@ class ResBlock(nn.Module):
         self.bn2 = nn.BatchNorm1d(in_channels)
         self.conv2 = nn.Conv1d(in_channels, in_channels, kernel_size=kernel_size, stride=stride, padding=padding, dilation=dilation)        
         
+        # Whether the convolutions keep the sequence length, so that no cropping is needed for the residual
+        self.same_length = stride == 1 and 2*padding == dilation*(kernel_size-1)
+        
         self.layer = nn.Sequential(nn.ReLU(),self.bn1, self.conv1, nn.ReLU(), self.bn2, self.conv2)
 
     def forward(self, x):
         out = self.layer(x)
         #print('out.shape, x.shape:', out.shape, x.shape)
-        d = x.shape[2] - out.shape[2]
-        out = x[:,:,0:x.shape[2]-d] + out
+        if self.same_length:
+            out = x + out
+        else:
+            out = x.narrow(2, 0, out.size(2)) + out
         
         return out
+    
+    def fuse_for_eval(self):
+        """Fold BatchNorm layers into adjacent convolutions (eval mode only)"""
+        self.layer = fuse_bn_conv_layers(self.layer)
+        
+        return self
 
 class ResBlock2(nn.Module):
     """Residual block unit"""
@@ -558,16 +621,27 @@ class ResBlock2(nn.Module):
         self.bn2 = nn.BatchNorm1d(in_channels)
         self.conv2 = nn.Conv1d(in_channels, in_channels, kernel_size=kernel_size, stride=stride, padding=padding, dilation=dilation)        
         
+        # Whether the convolutions keep the sequence length, so that no cropping is needed for the residual
+        self.same_length = stride == 1 and 2*padding == dilation*(kernel_size-1)
+        
         self.layer = nn.Sequential(self.bn1, nn.ReLU(),self.conv1, self.bn2, nn.ReLU(), self.conv2)
 
     def forward(self, x):
         out = self.layer(x)
         #print('out.shape, x.shape:', out.shape, x.shape)
-        d = x.shape[2] - out.shape[2]
-        out = x[:,:,0:x.shape[2]-d] + out
+        if self.same_length:
+            out = x + out
+        else:
+            out = x.narrow(2, 0, out.size(2)) + out
         
         return out
     
+    def fuse_for_eval(self):
+        """Fold BatchNorm layers into adjacent convolutions (eval mode only)"""
+        self.layer = fuse_bn_conv_layers(self.layer)
+        
+        return self
+    
 # Residual block ('bottleneck' version)
 class ResidualBlock(nn.Module):
     def __init__(self, in_channels, out_channels, stride=1):
@@ -606,11 +680,204 @@ class ResidualBlock(nn.Module):
             residual = self.conv4(out1)
         out += residual
         return out   
+    
+    def fuse_for_eval(self):
+        """Fold bn2/bn3 into the preceding convolutions (eval mode only)"""
+        self.conv1 = fuse_conv_bn(self.conv1, self.bn2)
+        self.bn2 = nn.Identity()
+        self.conv2 = fuse_conv_bn(self.conv2, self.bn3)
+        self.bn3 = nn.Identity()
+        
+        return self
+
+
+def bn_scale_shift(bn):
+    """Get the per-channel scale and shift of a BatchNorm layer in eval mode"""
+    scale = 1/torch.sqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = bn.weight * scale
+        shift = bn.bias - bn.running_mean * scale
+    else:
+        shift = -bn.running_mean * scale
+    
+    return scale.detach(), shift.detach()
+
+def fuse_conv_bn(conv, bn):
+    """Fold a BatchNorm1d layer into the preceding Conv1d layer"""
+    scale, shift = bn_scale_shift(bn)
+    
+    fused = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation, conv.groups, bias=True).to(conv.weight.device)
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1))
+        if conv.bias is not None:
+            fused.bias.copy_(conv.bias * scale + shift)
+        else:
+            fused.bias.copy_(shift)
+    
+    return fused
+
+class FusedBNConv1d(nn.Module):
+    """A BatchNorm1d layer folded into the following Conv1d layer (for inference only)"""
+    def __init__(self, bn, conv):
+        super(FusedBNConv1d, self).__init__()
+        
+        scale, shift = bn_scale_shift(bn)
+        
+        self.conv = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation, conv.groups, bias=True).to(conv.weight.device)
+        with torch.no_grad():
+            self.conv.weight.copy_(conv.weight * scale.view(1, -1, 1))
+            
+            # BN shift at non-padded positions is a constant for the output channels
+            interior = (conv.weight * shift.view(1, -1, 1)).sum(dim=(1, 2))
+            if conv.bias is not None:
+                self.conv.bias.copy_(conv.bias + interior)
+            else:
+                self.conv.bias.copy_(interior)
+        
+        # Zero padding is applied after BN in the unfused layers, so the BN shift
+        # should not contribute at padded positions; this is corrected at the edges
+        self.edge = BNConvEdgeCorrection(conv, shift, interior) if conv.padding[0] > 0 else None
+        
+    def forward(self, x):
+        # No data-dependent control flow here, so that the layer can be traced by FX quantization
+        out = self.conv(x)
+        
+        if self.edge is not None:
+            out = self.edge(out, x.size(2))
+        
+        return out
+
+class BNConvEdgeCorrection(nn.Module):
+    """
+    Correction of the output of a FusedBNConv1d layer at the zero-padded edges; 
+    not traced by quantize_distal_cnn(), so that it stays in FP32
+    """
+    def __init__(self, conv, shift, interior):
+        super(BNConvEdgeCorrection, self).__init__()
+        
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        
+        self.register_buffer('shift', shift.view(1, -1, 1))
+        self.register_buffer('orig_weight', conv.weight.detach().clone())
+        self.register_buffer('interior', interior.view(1, -1, 1))
+        self._edge_cache = {}
+    
+    def _edge_correction(self, seq_len, device):
+        key = (seq_len, device)
+        if key not in self._edge_cache:
+            bias = F.conv1d(self.shift.expand(1, -1, seq_len), self.orig_weight, None, self.stride, self.padding, self.dilation)
+            self._edge_cache[key] = bias - self.interior
+        
+        return self._edge_cache[key]
+    
+    def forward(self, out, seq_len):
+        corr = self._edge_correction(seq_len, out.device)
+        
+        p = self.padding[0]
+        if out.size(2) > 2*p:
+            out[:, :, :p] += corr[:, :, :p]
+            out[:, :, -p:] += corr[:, :, -p:]
+        else:
+            out += corr
+        
+        return out
+
+def fuse_bn_conv_layers(layers):
+    """Fold BatchNorm1d layers in an nn.Sequential into adjacent Conv1d layers"""
+    modules = list(layers.children())
+    fused = []
+    i = 0
+    while i < len(modules):
+        m = modules[i]
+        m_next = modules[i+1] if i+1 < len(modules) else None
+        
+        if isinstance(m, nn.Conv1d) and isinstance(m_next, nn.BatchNorm1d):
+            # Conv -> BN
+            fused.append(fuse_conv_bn(m, m_next))
+            i += 2
+        elif isinstance(m, nn.BatchNorm1d) and isinstance(m_next, nn.Conv1d) and m_next.stride == (1,) and m_next.groups == 1 and isinstance(m_next.padding, tuple):
+            # BN -> Conv (pre-activation ordering)
+            fused.append(FusedBNConv1d(m, m_next))
+            i += 2
+        else:
+            fused.append(m)
+            i += 1
+    
+    return nn.Sequential(*fused)
+
+def fuse_bn_linear(bn, linear):
+    """Fold a BatchNorm1d layer into the following Linear layer"""
+    scale, shift = bn_scale_shift(bn)
+    
+    fused = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+    with torch.no_grad():
+        fused.weight.copy_(linear.weight * scale.view(1, -1))
+        if linear.bias is not None:
+            fused.bias.copy_(linear.weight @ shift + linear.bias)
+        else:
+            fused.bias.copy_(linear.weight @ shift)
+    
+    return fused
+
+def fuse_bn_linear_layers(layers):
+    """Fold BatchNorm1d layers in an nn.Sequential into following Linear layers (Identity layers in between are skipped)"""
+    modules = list(layers.children())
+    fused = []
+    i = 0
+    while i < len(modules):
+        m = modules[i]
+        
+        if isinstance(m, nn.BatchNorm1d):
+            j = i + 1
+            while j < len(modules) and isinstance(modules[j], nn.Identity):
+                j += 1
+            
+            if j < len(modules) and isinstance(modules[j], nn.Linear):
+                # BN -> Linear
+                fused.append(fuse_bn_linear(m, modules[j]))
+                i = j + 1
+                continue
+        
+        fused.append(m)
+        i += 1
+    
+    # Keep the original container if nothing was folded
+    if len(fused) == len(modules):
+        return layers
+    
+    return nn.Sequential(*fused)
+
+def to_inference(model, fuse_conv=True):
+    """
+    Prepare a model for prediction only
+    
+    Sets eval mode, folds BatchNorm layers into convolutions (if fuse_conv) and 
+    into following Linear layers, and replaces Dropout layers with nn.Identity.
+    """
+    model.eval()
+    
+    if fuse_conv and hasattr(model, 'fuse_for_eval'):
+        model.fuse_for_eval()
+    
+    # Dropout does nothing in eval mode, but is still a module call per forward
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+    
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is nn.Sequential:
+                setattr(module, name, fuse_bn_linear_layers(child))
+    
+    return model
 
 
 class MuTransformer(nn.Module):
     """ResNet-only model"""
-    def __init__(self, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, nhead, dim_feedforward, trans_dropout, num_layers):
+    def __init__(self, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, nhead, dim_feedforward, trans_dropout, num_layers, norm_first=False):
         """  
         Args:
             in_channels: number of input channels
@@ -619,6 +886,7 @@ class MuTransformer(nn.Module):
             distal_radius: distal radius of a focal site to be considered
             distal_order: sequece order for distal sequences
             n_class: number of classes (labels)
+            norm_first: use pre-norm encoder layers (post-norm by default, as in existing models)
         """
         super(MuTransformer, self).__init__()
         
@@ -648,6 +916,8 @@ class MuTransformer(nn.Module):
             dim_feedforward=dim_feedforward,
             dropout=trans_dropout,
             activation='gelu',
+            batch_first=True,
+            norm_first=norm_first,
         )
         self.transformer_encoder = nn.TransformerEncoder(
             encoder_layer,
@@ -665,6 +935,9 @@ class MuTransformer(nn.Module):
         
         self.d_model = out_channels
         
+        # dtype for autocast (e.g. torch.bfloat16) of the forward pass; None for FP32
+        self.amp_dtype = None
+        
     
     def forward(self, local_input, distal_input):
         """
@@ -675,15 +948,24 @@ class MuTransformer(nn.Module):
             distal_input: distal input
         """
         
-        x = self.conv1(distal_input) #output shape: batch_size, out_channels, L_out
-        x = x.permute(2, 0, 1)
-        x = x * math.sqrt(self.d_model)
-        x = self.pos_encoder(x)
-        x = self.transformer_encoder(x)
-        x = x.mean(dim=0)
-        x = self.classifier(x)
+        with autocast_context(distal_input.device.type, self.amp_dtype):
+            x = self.conv1(distal_input) #output shape: batch_size, out_channels, L_out
+            x = x.transpose(1, 2).contiguous() #shape: batch_size, L_out, out_channels
+            x = x * math.sqrt(self.d_model)
+            x = self.pos_encoder(x)
+            x = self.transformer_encoder(x)
+            x = x.mean(dim=1)
+            x = self.classifier(x)
         
-        return x
+        return x.float()
+    
+    def fuse_for_eval(self):
+        """Fold the input BatchNorm layer into the 1st convolution (eval mode only)"""
+        assert not self.training, 'fuse_for_eval() should be called after model.eval()'
+        
+        self.conv1 = fuse_bn_conv_layers(self.conv1)
+        
+        return self
         
 '''
 class PositionalEncoding(nn.Module):
@@ -717,15 +999,22 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(max_len, 1, d_model)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
-        self.register_buffer('pe', pe)
+        pe = torch.zeros(1, max_len, d_model)
+        pe[0, :, 0::2] = torch.sin(position * div_term)
+        pe[0, :, 1::2] = torch.cos(position * div_term)
+        # Not saved in checkpoints, as it is recomputed at construction
+        self.register_buffer('pe', pe, persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints still contain pe; drop it so that strict loading works
+        state_dict.pop(prefix + 'pe', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         """
         Args:
-            x: Tensor, shape [seq_len, batch_size, embedding_dim]
+            x: Tensor, shape [batch_size, seq_len, embedding_dim]
         """
-        x = x + self.pe[:x.size(0)]
+        # In-place add, as x is a fresh (non-leaf) activation
+        x.add_(self.pe[:, :x.size(1)])
         return self.dropout(x)
\ No newline at end of file
@@ -5,6 +5,9 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import sys
+import inspect
+
+from MuRaL.preprocessing import SEQ_CODE_OHE
 
 
 def weights_init(m):
@@ -30,6 +33,73 @@ def weights_init(m):
                 if 'weight' in p:
                     torch.nn.init.xavier_uniform_(m.__getattr__(p))
 
+def get_optimizer(optim_name, params, learning_rate, weight_decay, device):
+    """
+    Create the optimizer for training; Adam/AdamW use the fused CUDA implementation 
+    if the PyTorch version supports it. Return None for unsupported methods.
+    """
+    if optim_name in ('Adam', 'AdamW'):
+        optim_class = torch.optim.Adam if optim_name == 'Adam' else torch.optim.AdamW
+        
+        kwargs = {}
+        if device.type == 'cuda' and 'fused' in inspect.signature(optim_class).parameters:
+            kwargs['fused'] = True
+        
+        return optim_class(params, lr=learning_rate, weight_decay=weight_decay, **kwargs)
+    
+    elif optim_name == 'SGD':
+        return torch.optim.SGD(params, lr=learning_rate, weight_decay=weight_decay, momentum=0.98, nesterov=True)
+    
+    return None
+
+# One-hot lookup tables of the seq codes, one per device
+_seq_code_ohe = {}
+
+def expand_seq_codes(distal_x):
+    """Expand uint8 seq codes (n, seq_len) to one-hot data (n, 4, seq_len) on the device of the codes"""
+    table = _seq_code_ohe.get(distal_x.device)
+    if table is None:
+        table = _seq_code_ohe[distal_x.device] = torch.from_numpy(SEQ_CODE_OHE).to(distal_x.device)
+    
+    return F.embedding(distal_x.long(), table).transpose(1, 2).contiguous()
+
+class CUDAPrefetcher(object):
+    """
+    Wrap a DataLoader so that the next batch is copied to the GPU on a side CUDA 
+    stream while the current batch is used for computation
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        
+        while next_batch is not None:
+            # Wait for the copy of the batch and keep its memory until the compute stream is done with it
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for t in next_batch:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            
+            batch = next_batch
+            next_batch = self._preload(loader_iter)
+            yield batch
+    
+    def _preload(self, loader_iter):
+        """Start copying the next batch to the GPU; return None at the end"""
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        
+        with torch.cuda.stream(self.stream):
+            return tuple(t.to(self.device, non_blocking=True) for t in batch)
+
 def model_predict_m(model, dataloader, criterion, device, n_class, distal=True):
     """Do model prediction using dataloader"""
     model.to(device)
@@ -40,10 +110,13 @@ def model_predict_m(model, dataloader, criterion, device, n_class, distal=True):
     
     with torch.no_grad():
         for y, cont_x, cat_x, distal_x in dataloader:
-            cat_x = cat_x.to(device)
-            cont_x = cont_x.to(device)
-            distal_x = distal_x.to(device)
-            y  = y.to(device)
+            cat_x = cat_x.to(device, non_blocking=True)
+            cont_x = cont_x.to(device, non_blocking=True)
+            distal_x = distal_x.to(device, non_blocking=True)
+            y  = y.to(device, non_blocking=True)
+            
+            if distal_x.dtype == torch.uint8:
+                distal_x = expand_seq_codes(distal_x)
         
             if distal:
                 preds = model.forward((cont_x, cat_x), distal_x)
@@ -59,4 +132,82 @@ def model_predict_m(model, dataloader, criterion, device, n_class, distal=True):
                     #print('in the model_predict_m:', device)
                     sys.stdout.flush()
 
-    return pred_y, total_loss
\ No newline at end of file
+    return pred_y, total_loss
+
+# Convolutional submodules of the distal branches in Network1/Network2
+DISTAL_CNN_LAYERS = ['conv1', 'RBs1', 'conv2', 'RBs2', 'conv3', 'conv1_2', 'RBs1_2', 'conv2_2', 'RBs2_2', 'conv3_2']
+
+def quantize_distal_cnn(model, dataloader, n_batches=10):
+    """
+    Post-training static INT8 quantization (CPU only) of the distal CNN layers
+    
+    Each convolutional submodule is quantized separately with FX graph mode
+    quantization, so that the residual adds between them and the FC layers
+    and softmax mixture stay in FP32. FX only fuses Conv->BN pairs, so the 
+    (pre-activation) BN->Conv pairs should be folded by fuse_for_eval() first, 
+    e.g. with to_inference(); the edge corrections of the folded layers 
+    (BNConvEdgeCorrection) and any BN layers left unfolded run in FP32. 
+    Submodules shared between the branches (share_distal_cnn) stay shared.
+    
+    Args:
+        model: a Network1/Network2 model on CPU
+        dataloader: DataLoader for calibration data
+        n_batches: number of batches used for calibration
+    """
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from MuRaL.nn_models import BNConvEdgeCorrection
+    
+    torch.backends.quantized.engine = 'fbgemm'
+    qconfig_dict = {'': get_default_qconfig('fbgemm'), 'object_type': [(BNConvEdgeCorrection, None)]}
+    prepare_custom_config = {'non_traceable_module_class': [BNConvEdgeCorrection]}
+    
+    names = [name for name in DISTAL_CNN_LAYERS if isinstance(getattr(model, name, None), nn.Module)]
+    if len(names) == 0:
+        print('Warning: no distal CNN layers to quantize!')
+        return model
+    
+    # Quantize each unique submodule once (as in fuse_for_eval()), and assign the result to all its names
+    unique_modules = {}
+    for name in names:
+        unique_modules.setdefault(id(getattr(model, name)), []).append(name)
+    aliases = {alias_names[0]:alias_names for alias_names in unique_modules.values()}
+    names = list(aliases.keys())
+    
+    def set_module(name, module):
+        for alias_name in aliases[name]:
+            setattr(model, alias_name, module)
+    
+    def calibrate(max_batches):
+        with torch.no_grad():
+            for i, (y, cont_x, cat_x, distal_x) in enumerate(dataloader):
+                if i >= max_batches:
+                    break
+                model.forward((cont_x, cat_x), distal_x)
+    
+    # Record example inputs of the submodules, needed by newer versions of prepare_fx()
+    example_inputs = {}
+    def record_input(name):
+        def hook(module, inputs):
+            example_inputs.setdefault(name, inputs)
+        return hook
+    
+    handles = [getattr(model, name).register_forward_pre_hook(record_input(name)) for name in names]
+    calibrate(1)
+    for handle in handles:
+        handle.remove()
+    
+    for name in names:
+        try:
+            prepared = prepare_fx(getattr(model, name), qconfig_dict, example_inputs=example_inputs[name], prepare_custom_config=prepare_custom_config)
+        except TypeError:
+            prepared = prepare_fx(getattr(model, name), qconfig_dict, prepare_custom_config_dict=prepare_custom_config)
+        set_module(name, prepared)
+    
+    # Collect activation statistics for the observers
+    calibrate(n_batches)
+    
+    for name in names:
+        set_module(name, convert_fx(getattr(model, name)))
+    
+    return model
@@ -16,6 +16,8 @@ import numpy as np
 import h5py
 import time
 
+from numpy.lib.stride_tricks import sliding_window_view
+
 from sklearn import metrics, calibration
 from itertools import product
 
@@ -24,7 +26,50 @@ from itertools import repeat
 from multiprocessing import Pool
 import re
 import subprocess
-
+import shutil
+import json
+import hashlib
+
+
+# Bases (incl. IUPAC ambiguity codes) for the uint8 encoding of distal sequences; 
+# codes are positions in SEQ_CODES, and SEQ_CODES_RC has the complementary bases
+SEQ_CODES = 'ACGTRYMSWKBDHVN'
+SEQ_CODES_RC = 'TGCAYRKSWMVHDBN'
+
+# One-hot encoding for each code, same as in get_digitalized_seq_ohe()
+SEQ_CODE_OHE = np.array([[1,0,0,0], #A
+                         [0,1,0,0], #C
+                         [0,0,1,0], #G
+                         [0,0,0,1], #T
+                         [0.5,0,0.5,0], #R: A,G
+                         [0,0.5,0,0.5], #Y: C,T
+                         [0.5,0.5,0,0], #M: A,C
+                         [0,0.5,0.5,0], #S: C,G
+                         [0.5,0,0,0.5], #W: A,T
+                         [0,0,0.5,0.5], #K: G,T
+                         [0,1/3,1/3,1/3], #B: not A
+                         [1/3,0,1/3,1/3], #D: not C
+                         [1/3,1/3,0,1/3], #H: not G
+                         [1/3,1/3,1/3,0], #V: not T
+                         [0.25,0.25,0.25,0.25]], dtype=np.float32) #N
+
+# Compression settings for the distal_X datasets in H5 files; 'lzf' is much faster to read than 'gzip'
+H5_COMPRESSION = {'gzip': {'compression':'gzip', 'compression_opts':4},
+                  'lzf': {'compression':'lzf'},
+                  'none': {}}
+H5_COMPRESSION_DEFAULT = 'lzf'
+
+# Raw data chunk cache for reading H5 files (the default of 1 MB holds few chunks)
+H5_RDCC_NBYTES = 64*1024*1024
+H5_RDCC_NSLOTS = 1000003
+
+# One-hot encoding of the complementary base for each code, and the code for padding
+SEQ_CODE_OHE_RC = SEQ_CODE_OHE[[SEQ_CODES.index(c) for c in SEQ_CODES_RC]]
+SEQ_CODE_N = SEQ_CODES.index('N')
+
+# Complementary code of each code, and the digit encoding (A:0, C:1, G:2, T:3, others:-1) of each code
+SEQ_CODE_COMP = np.array([SEQ_CODES.index(c) for c in SEQ_CODES_RC], dtype=np.uint8)
+SEQ_CODE_DIGITS = np.array([0, 1, 2, 3] + [-1]*(len(SEQ_CODES)-4), dtype=np.int32)
 
 def to_np(tensor):
     """Convert Tensor to numpy arrays"""
@@ -33,7 +78,7 @@ def to_np(tensor):
     else:
         return tensor.detach().numpy()
 
-def get_h5f_path(bed_file, bw_names, distal_radius, distal_order):
+def get_h5f_path(bed_file, bw_names, distal_radius, distal_order, seq_codes=False):
     """Get the H5 file path name based on input data"""
     
     h5f_path = bed_file + '.distal_' + str(distal_radius)
@@ -44,14 +89,63 @@ def get_h5f_path(bed_file, bw_names, distal_radius, distal_order):
     if len(bw_names) > 0:
         h5f_path = h5f_path + '.' + '.'.join(list(bw_names))
     
+    if seq_codes:
+        h5f_path = h5f_path + '.codes'
+    
     h5f_path = h5f_path + '.h5'
     
     return h5f_path
 
-def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_size, chunk_size=50000):
+class BedFrame(object):
+    """
+    Lightweight replacement for BedTool(bed_file) where only the file name, the 
+    number of sites or the site columns are needed (e.g. for generate_h5fv2 and the 
+    local data caches); the BED file is parsed once with the pandas C parser instead
+    of iterating BedTool intervals
+    """
+    def __init__(self, bed_file):
+        self.fn = bed_file
+        self._df = None
+    
+    @property
+    def df(self):
+        """DataFrame with columns chrom, start, end, mut_type and strand"""
+        if self._df is None:
+            self._df = pd.read_csv(self.fn, sep='\t', header=None, usecols=[0,1,2,4,5], comment='#', dtype={0:'category', 1:np.int64, 2:np.int64, 4:np.int8, 5:'category'}, engine='c')
+            self._df.columns = ['chrom', 'start', 'end', 'mut_type', 'strand']
+        
+        return self._df
+    
+    def __len__(self):
+        return self.df.shape[0]
+
+def stage_h5f(h5f_path, out_dir):
+    """Copy an H5 file (and the H5 files it links to, if split) into another folder, e.g. under /dev/shm"""
+    new_h5f_path = os.path.join(out_dir, os.path.basename(h5f_path))
+    
+    with h5py.File(h5f_path, 'r') as hf:
+        links = {key:hf.get(key, getlink=True) for key in hf.keys()}
+    
+    if len(links) > 1 and all(isinstance(link, h5py.ExternalLink) for link in links.values()):
+        # Copy the linked files and point the links to the copies
+        with h5py.File(new_h5f_path, 'w') as hf:
+            for key, link in links.items():
+                new_h5f_path_i = os.path.join(out_dir, os.path.basename(link.filename))
+                shutil.copyfile(link.filename, new_h5f_path_i)
+                hf[key] = h5py.ExternalLink(new_h5f_path_i, link.path)
+    else:
+        shutil.copyfile(h5f_path, new_h5f_path)
+    
+    return new_h5f_path
+
+def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_size, chunk_size=50000, seq_codes=False, compression=H5_COMPRESSION_DEFAULT):
     """Generate the H5 file for storing distal data"""
     n_channels = 4**distal_order + len(bw_files)
     
+    # Seq codes are stored in 2D datasets, i.e. (n_sites, seq_len)
+    if seq_codes:
+        n_channels = distal_radius*2+1
+    
     write_h5f = True
     if os.path.exists(h5f_path):
         try:
@@ -78,19 +172,26 @@ def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order,
             
             # Create distal_X dataset
             # Note, the default dtype for create_dataset is numpy.float32
-            hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(h5_chunk_size,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+            if seq_codes:
+                hf.create_dataset(name='distal_X', shape=(0, seq_len), dtype=np.uint8, chunks=(h5_chunk_size, seq_len), maxshape=(None, seq_len), **H5_COMPRESSION[compression])
+            else:
+                hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), chunks=(h5_chunk_size,n_channels, seq_len), maxshape=(None,n_channels, seq_len), **H5_COMPRESSION[compression]) 
             
             # Write data in chunks
             # chunk_size = 50000
-            seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
+            seq_codes_dict = get_seq_codes_dict(ref_genome)
+            bed_sites = get_bed_sites(bed_regions)
             for start in range(0, len(bed_regions), chunk_size):
                 end = min(start+chunk_size, len(bed_regions))
                 
                 # Extract sequence from the genome, which is in one-hot encoding format
-                seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
+                if seq_codes:
+                    seqs = get_digitalized_seq_codes(seq_codes_dict, bed_sites.iloc[start:end], distal_radius)
+                else:
+                    seqs = get_digitalized_seq_ohe(seq_codes_dict, bed_sites.iloc[start:end], distal_radius)
                 
                 # Handle distal bigWig data, return base-wise values
-                if len(bw_files) > 0:
+                if len(bw_files) > 0 and not seq_codes:
  
                     bw_distal = get_bw_for_bed(bw_files, bed_regions.at(range(start, end)), distal_radius)
 
@@ -103,10 +204,68 @@ def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order,
     return None
 
 
-def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=50000, n_h5_files=1):
-    """Generate the H5 file for storing distal data"""
+def get_files_hash(files):
+    """Get a hash of the real paths, sizes and modification times of files (e.g. bigWig files or the reference genome)"""
+    files_hash = hashlib.sha1()
+    for file in files:
+        files_hash.update((os.path.realpath(file) + '\t' + str(os.path.getsize(file)) + '\t' + str(os.path.getmtime(file)) + '\n').encode())
+    
+    return files_hash.hexdigest()
+
+def get_h5f_fingerprint(h5f_path, bed_file, ref_genome, distal_radius, distal_order, bw_files, seq_codes=False):
+    """Get a fingerprint of the inputs of an H5 file and of the H5 file itself (not following the link)"""
+    return {'bed_mtime': os.path.getmtime(bed_file), 
+            'bed_size': os.path.getsize(bed_file), 
+            'ref_mtime': os.path.getmtime(ref_genome), 
+            'distal_radius': distal_radius, 
+            'distal_order': distal_order, 
+            'bw_files_hash': get_files_hash(bw_files), 
+            'seq_codes': seq_codes,
+            'h5_mtime': os.lstat(h5f_path).st_mtime, 
+            'h5_size': os.lstat(h5f_path).st_size}
+
+def h5f_is_fresh(h5f_path, bed_file, ref_genome, distal_radius, distal_order, bw_files, seq_codes=False):
+    """Check whether the H5 file matches the fingerprint in its sidecar file (<h5f_path>.fp)"""
+    try:
+        with open(h5f_path + '.fp', 'r') as f:
+            fp = json.load(f)
+        
+        return fp == get_h5f_fingerprint(h5f_path, bed_file, ref_genome, distal_radius, distal_order, bw_files, seq_codes)
+    except (OSError, ValueError):
+        return False
+
+def write_h5f_fingerprint(h5f_path, bed_file, ref_genome, distal_radius, distal_order, bw_files, seq_codes=False):
+    """Write the fingerprint of a valid H5 file to its sidecar file (<h5f_path>.fp)"""
+    fp_path = h5f_path + '.fp'
+    tmp_path = fp_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(get_h5f_fingerprint(h5f_path, bed_file, ref_genome, distal_radius, distal_order, bw_files, seq_codes), f)
+        os.replace(tmp_path, fp_path)
+    except OSError as e:
+        print('Warning: failed to write the fingerprint of the H5 file:', fp_path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=50000, n_h5_files=1, seq_codes=False, h5_chunk_size=1, compression=H5_COMPRESSION_DEFAULT):
+    """
+    Generate the H5 file for storing distal data
+    
+    h5_chunk_size is the number of sites per HDF5 chunk: small chunks suit shuffled 
+    (random) reads, and larger ones suit files read in order (e.g. validation data)
+    """
     n_channels = 4**distal_order + len(bw_files)
     
+    # Seq codes are stored in 2D datasets, i.e. (n_sites, seq_len), without bigWig tracks
+    if seq_codes:
+        n_channels = distal_radius*2+1
+        bw_paths = None
+        bw_files = []
+    
+    # Skip the checks below (which need the number of sites in the BED file) if the inputs are unchanged
+    if h5f_is_fresh(h5f_path, bed_regions.fn, ref_genome, distal_radius, distal_order, bw_files, seq_codes):
+        return None
+    
     write_h5f = True
     if os.path.exists(h5f_path):
         try:
@@ -146,18 +305,28 @@ def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_orde
                  '--distal_radius', str(distal_radius), 
                  '--distal_order', str(distal_order), 
                  '--n_files', str(n_h5_files), 
-                 '--chunk_size', str(chunk_size)]
+                 '--chunk_size', str(chunk_size),
+                 '--h5_chunk_size', str(h5_chunk_size),
+                 '--compression', compression]
         if bw_paths != None:
             args.append('--bw_paths')
             args.append(bw_paths)
+        if seq_codes:
+            args.append('--seq_codes')
         p = subprocess.Popen(args)
         p.wait()
+        
+        if p.returncode != 0 or not os.path.exists(h5f_path):
+            print('ERROR: failed to generate the H5 file:', h5f_path, file=sys.stderr)
+            raise RuntimeError('gen_distal_h5 failed with return code ' + str(p.returncode) + ' for ' + h5f_path)
+    
+    write_h5f_fingerprint(h5f_path, bed_regions.fn, ref_genome, distal_radius, distal_order, bw_files, seq_codes)
             
     return None
 
 
 
-def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, chunk_size):
+def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, chunk_size, seq_codes=False, h5_chunk_size=1, compression=H5_COMPRESSION_DEFAULT):
     """generate an HDF file for specific regions"""
     #bed_regions = BedTool(bed_file)
     n_channels = 4**distal_order + len(bw_files)
@@ -172,20 +341,27 @@ def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, dist
 
         # Create distal_X dataset
         # Note, the default dtype for create_dataset is numpy.float32
-        hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(1,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+        if seq_codes:
+            hf.create_dataset(name='distal_X', shape=(0, seq_len), dtype=np.uint8, chunks=(h5_chunk_size, seq_len), maxshape=(None, seq_len), **H5_COMPRESSION[compression])
+        else:
+            hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), chunks=(h5_chunk_size,n_channels, seq_len), maxshape=(None,n_channels, seq_len), **H5_COMPRESSION[compression]) 
 
         # Write data in chunks
         #chunk_size = 50000
         
-        seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
+        seq_codes_dict = get_seq_codes_dict(ref_genome)
+        bed_sites = get_bed_sites(bed_regions)
         for start in range(0, len(bed_regions), chunk_size):
             end = min(start+chunk_size, len(bed_regions))
 
             # Extract sequence from the genome, which is in one-hot encoding format
-            seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
+            if seq_codes:
+                seqs = get_digitalized_seq_codes(seq_codes_dict, bed_sites.iloc[start:end], distal_radius)
+            else:
+                seqs = get_digitalized_seq_ohe(seq_codes_dict, bed_sites.iloc[start:end], distal_radius)
             
             # Handle distal bigWig data, return base-wise values
-            if len(bw_files) > 0:
+            if len(bw_files) > 0 and not seq_codes:
                 bw_distal = get_bw_for_bed(bw_files, bed_regions.at(range(start, end)), distal_radius)
 
                 # Concatenate the sequence data and the bigWig data
@@ -197,7 +373,7 @@ def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, dist
     
     return h5f_path
 
-def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, binsize, bw_files, chunk_size):
+def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, binsize, bw_files, chunk_size, h5_chunk_size=1, compression=H5_COMPRESSION_DEFAULT):
     
     #bed_regions = BedTool(bed_file)
     n_channels = 4**distal_order + len(bw_files)
@@ -219,17 +395,18 @@ def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, dist
 
         # Create distal_X dataset
         # Note, the default dtype for create_dataset is numpy.float32
-        hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(1,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+        hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), chunks=(h5_chunk_size,n_channels, seq_len), maxshape=(None,n_channels, seq_len), **H5_COMPRESSION[compression]) 
 
         # Write data in chunks
         #chunk_size = 50000
         
-        seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
+        seq_codes_dict = get_seq_codes_dict(ref_genome)
+        bed_sites = get_bed_sites(bed_regions)
         for start in range(0, len(bed_regions), chunk_size):
             end = min(start+chunk_size, len(bed_regions))
 
             # Extract sequence from the genome, which is in one-hot encoding format
-            seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
+            seqs = get_digitalized_seq_ohe(seq_codes_dict, bed_sites.iloc[start:end], distal_radius)
             
             # Handle distal bigWig data, return base-wise values
             if len(bw_files) > 0:
@@ -255,89 +432,170 @@ def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, dist
     return h5f_path
 
 
-def get_digitalized_seq(ref_genome, bed_regions, radius, order):
-    seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    digit_encoder = {'A':0,'C':1,'G':2,'T':3,
-               'R':-1, #A,G
-               'Y':-1, #C,T
-               'M':-1, #A,C
-               'S':-1, #C,G
-               'W':-1, #A,T
-               'K':-1, #G,T
-               'B':-1, #not A
-               'D':-1, #not C
-               'H':-1, #not G
-               'V':-1, #not T
-               'N':-1}
-
-    digit_encoder_rc = {'A':3, 'C':2, 'G':1, 'T':0,
-               'R':-1, #A,G
-               'Y':-1, #C,T
-               'M':-1, #A,C
-               'S':-1, #C,G
-               'W':-1, #A,T
-               'K':-1, #G,T
-               'B':-1, #not A
-               'D':-1, #not C
-               'H':-1, #not G
-               'V':-1, #not T
-               'N':-1}
-
-    #self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    digit_seqs = []
-    for region in bed_regions:
-        chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
-
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(seq_records[chrom].seq)
+def get_bed_sites(bed_regions):
+    """
+    Get a DataFrame with the columns chrom, start, end and strand of the sites; file-backed 
+    BED regions are read with the pandas C parser instead of iterating the intervals
+    """
+    if isinstance(bed_regions, pd.DataFrame):
+        return bed_regions
+    if isinstance(bed_regions, BedFrame):
+        return bed_regions.df
+    if isinstance(getattr(bed_regions, 'fn', None), str) and os.path.isfile(bed_regions.fn):
+        return BedFrame(bed_regions.fn).df
+    
+    return pd.DataFrame([(str(region.chrom), int(region.start), int(region.stop), region.strand) for region in bed_regions], columns=['chrom', 'start', 'end', 'strand'])
+
+def get_seq_code_windows(seq_codes_dict, bed_regions, radius):
+    """
+    Extract the seq codes (see SEQ_CODES) of the windows of 2*radius+1 bp centered on 
+    the start positions of the sites in bed_regions, batched per chromosome with NumPy; 
+    windows exceeding the chromosome ends are padded with 'N' and windows not on the 
+    '+' strand are reverse complemented. The rows are in the same order as bed_regions 
+    (see get_bed_sites() for the accepted types). 
+    """
+    seq_len = 2*radius + 1
+    
+    sites = get_bed_sites(bed_regions)
+    windows = np.empty((len(sites), seq_len), dtype=np.uint8)
+    if len(sites) == 0:
+        return windows
+    
+    site_starts = sites['start'].values.astype(np.int64)
+    
+    for chrom, idx in sites.groupby('chrom', sort=False, observed=True).indices.items():
+        long_seq = seq_codes_dict[str(chrom)]
         long_seq_len = len(long_seq)
+        
+        starts = site_starts[idx] - radius
+        inside = (starts >= 0) & (starts + seq_len <= long_seq_len)
+        
+        # Windows within the chromosome are views of the chromosome sequence
+        if np.any(inside):
+            windows[idx[inside]] = sliding_window_view(long_seq, seq_len)[starts[inside]]
+        
+        # Pad the windows at the chromosome ends
+        for i in idx[~inside]:
+            start1 = max(site_starts[i]-radius, 0)
+            stop1 = min(site_starts[i]+1+radius, long_seq_len)
+            short_seq = long_seq[start1:stop1]
+            
+            pad_seq = np.full(seq_len - len(short_seq), SEQ_CODE_N, dtype=np.uint8)
+            if start1 == 0:
+                windows[i] = np.concatenate([pad_seq, short_seq])
+            else:
+                windows[i] = np.concatenate([short_seq, pad_seq])
+    
+    minus = (np.asarray(sites['strand']) != '+')
+    windows[minus] = SEQ_CODE_COMP[windows[minus, ::-1]]
+    
+    return windows
 
-        start1 = np.max([int(start)-radius, 0])
-        stop1 = np.min([int(stop)+radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
+def get_digitalized_seq(ref_genome, bed_regions, radius, order, seq_codes_dict=None):
+    """
+    Encode the local sequences of the sites as digits (A:0, C:1, G:2, T:3), or as 
+    k-mer codes for order > 1; k-mers with ambiguous bases are encoded as -1
+    
+    Args:
+        seq_codes_dict: reference genome from get_seq_codes_dict(); read from ref_genome if None
+    """
+    if seq_codes_dict is None:
+        seq_codes_dict = get_seq_codes_dict(ref_genome)
+    
+    digit_seqs = SEQ_CODE_DIGITS[get_seq_code_windows(seq_codes_dict, bed_regions, radius)]
+    
+    if order > 1:
+        kmers = sliding_window_view(digit_seqs, order, axis=1)
+        kmer_weights = 4**np.arange(order-1, -1, -1, dtype=np.int32)
+        digit_seqs = np.where(np.any(kmers < 0, axis=2), -1, np.sum(kmers*kmer_weights, axis=2))
+    
+    return digit_seqs.astype(np.int32)
 
-        seq_len = 2*radius + 1 
+def get_local_seq_cache_path(bed_file, ref_genome, radius, order):
+    """Get the path of the cached local seq encodings for a BED file, keyed by a hash of the reference genome file"""
+    return bed_file + '.local_' + str(radius) + '_' + str(order) + '.' + get_files_hash([ref_genome])[:12] + '.npy'
 
-        if(len(short_seq) < seq_len):
-            #print('warning:', chrom, start1, stop1, long_seq_len)
-            if start1 == 0:
-                short_seq = (seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
-            else:
-                short_seq = short_seq + (seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([digit_encoder[c] for c in short_seq], axis=1)
-        if strand == '+':
-            digit_seq = np.array([digit_encoder[c] for c in short_seq])
-        else:
-            #a = [digit_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            digit_seq = np.array([digit_encoder_rc[c] for c in short_seq[::-1]])
-            
-        if order > 1:
-            new_seq = []
-            for i in range(seq_len - order +1):
-                kmer = digit_seq[i:i+order]
-                if min(kmer) < 0:
-                    new_seq.append(-1)
-                else:
-                    digit = sum([kmer[d]*4**(order-d-1) for d in range(order)])
-                    new_seq.append(digit)
-            
-            digit_seq = np.array(new_seq)
-        
-        if len(digit_seq) != seq_len - order +1:
-            print('digit_seq.shape:', digit_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
-        digit_seqs.append(digit_seq)
+def get_local_bw_cache_path(bed_file, bw_files, bw_names, radius):
+    """Get the path of the cached local bigWig features for a BED file, keyed by a hash of the bigWig paths and mtimes"""
+    return bed_file + '.local_bw_' + str(radius) + '.' + '.'.join(list(bw_names)) + '.' + get_files_hash(bw_files)[:12] + '.npy'
+
+def load_npy_cache(cache_path, dep_files, shape):
+    """Load a cached array (memory-mapped) if it is newer than all dep_files and has the given shape; otherwise return None"""
+    if not os.path.exists(cache_path):
+        return None
+    
+    try:
+        if all(os.path.getmtime(dep_file) < os.path.getmtime(cache_path) for dep_file in dep_files):
+            data = np.load(cache_path, mmap_mode='r')
+            if data.shape == shape:
+                return data
+    except (OSError, ValueError):
+        pass
     
-    digit_seqs = np.array(digit_seqs, dtype=np.int32)
+    print('Warning: re-generating the cached data:', cache_path)
+    return None
+
+def save_npy_cache(cache_path, data):
+    """Save an array to a .npy file; write to a temporary file first, so that other processes never read an incomplete file"""
+    tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print('Warning: failed to cache the data:', cache_path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_digitalized_seq_cached(ref_genome, bed_regions, radius, order, seq_codes_dict=None, write_cache=True):
+    """
+    Same as get_digitalized_seq(), but the encodings are cached in a .npy file next 
+    to the BED file, so that they are computed only once for all trials; bed_regions 
+    can be a BedFrame or a BedTool. A cached array is returned memory-mapped, in the 
+    integer type it is stored in (int8 if the codes fit).
+    
+    Args:
+        seq_codes_dict: an empty dict is filled with the reference genome on the first 
+            cache miss, so that it can be reused in later calls
+        write_cache: whether to write the cache file on a cache miss
+    """
+    cache_path = get_local_seq_cache_path(bed_regions.fn, ref_genome, radius, order)
+    seq_len = 2*radius + 1 - (order-1)
+    
+    digit_seqs = load_npy_cache(cache_path, [bed_regions.fn, ref_genome], (len(bed_regions), seq_len))
+    if digit_seqs is not None:
+        return digit_seqs
+    
+    if seq_codes_dict is not None and len(seq_codes_dict) == 0:
+        seq_codes_dict.update(get_seq_codes_dict(ref_genome))
+    
+    digit_seqs = get_digitalized_seq(ref_genome, bed_regions, radius, order, seq_codes_dict=seq_codes_dict or None)
+    
+    # Use a small integer type if all codes fit in it
+    if write_cache:
+        save_npy_cache(cache_path, digit_seqs.astype(np.int8) if 4**order <= 127 else digit_seqs)
     
     return digit_seqs
 
+def get_mean_bw_for_bed_cached(bw_files, bw_names, bed_regions, radius, write_cache=True):
+    """
+    Same as get_mean_bw_for_bed(), but the features are cached in a .npy file next 
+    to the BED file, so that the bigWig files are read only once for all trials; 
+    bed_regions can be a BedFrame or a BedTool; the cache file is written on a cache
+    miss only if write_cache
+    """
+    cache_path = get_local_bw_cache_path(bed_regions.fn, bw_files, bw_names, radius)
+    
+    bw_data = load_npy_cache(cache_path, [bed_regions.fn] + list(bw_files), (len(bed_regions), len(bw_files)))
+    if bw_data is not None:
+        return pd.DataFrame(np.array(bw_data), columns=bw_names)
+    
+    bw_data = get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius)
+    if write_cache:
+        save_npy_cache(cache_path, bw_data.values)
+    
+    return bw_data
+
 def get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius):
 
     bw_fh = []
@@ -347,9 +605,9 @@ def get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius):
     bw_data = np.zeros((len(bed_regions), len(bw_fh)), dtype=float)
     
     if len(bw_fh) > 0:
+        sites = get_bed_sites(bed_regions)
         
-        for i, region in enumerate(bed_regions):
-            chrom, start, stop = str(region.chrom), region.start, region.stop
+        for i, (chrom, start, stop) in enumerate(zip(sites['chrom'].astype(str), sites['start'], sites['end'])):
             #bw_values = []
             #seq_len = [bw.chroms(chrom) for bw in bw_fh]
             
@@ -364,80 +622,35 @@ def get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius):
     
     return bw_data
 
-def get_digitalized_seq_ohe(seq_records, bed_regions, distal_radius):
-
-    one_hot_encoder = {'A':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'C':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'G':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'T':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'R':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #C,T
-               'M':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #G,T
-               'B':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-    one_hot_encoder_rc = {'A':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'C':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'G':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'T':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'R':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #C,T
-               'M':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #G,T
-               'B':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-    #self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    distal_seqs = []
-    for region in bed_regions:
-        chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
-
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(seq_records[chrom].seq)
-        long_seq_len = len(long_seq)
-
-        start1 = np.max([int(start)-distal_radius, 0])
-        stop1 = np.min([int(stop)+distal_radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
-
-        seq_len = 2*distal_radius + 1 
+def get_digitalized_seq_ohe(seq_codes_dict, bed_regions, distal_radius):
+    """One-hot encode the distal sequences of the sites (see SEQ_CODE_OHE); returns an array of shape (n_sites, 4, 2*distal_radius+1)"""
+    distal_seqs = get_seq_code_windows(seq_codes_dict, bed_regions, distal_radius)
+    
+    return np.ascontiguousarray(SEQ_CODE_OHE[distal_seqs].transpose(0, 2, 1))
 
-        if(len(short_seq) < seq_len):
-            #print('warning:', chrom, start1, stop1, long_seq_len)
-            if start1 == 0:
-                short_seq = (seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
-            else:
-                short_seq = short_seq + (seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
-        if strand == '+':
-            distal_seq = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
-        else:
-            #a = [one_hot_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            distal_seq = np.concatenate([one_hot_encoder_rc[c] for c in short_seq[::-1]], axis=1)
-        if distal_seq.shape[1] != seq_len:
-            print('distal_seq.shape:', distal_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
-        distal_seqs.append(distal_seq)
+def get_seq_codes_dict(ref_genome):
+    """Read the reference genome into a dict of uint8 seq code arrays (see SEQ_CODES), one per chromosome; unknown bases are encoded as N"""
+    codes_table = str.maketrans(SEQ_CODES, ''.join([chr(i) for i in range(len(SEQ_CODES))]))
     
-    distal_seqs = np.array(distal_seqs)
+    seq_codes_dict = {}
+    for record in SeqIO.parse(open(ref_genome, 'r'), 'fasta'):
+        seq_codes = np.frombuffer(str(record.seq).upper().translate(codes_table).encode('latin-1', errors='replace'), dtype=np.uint8)
+        unknown = (seq_codes >= len(SEQ_CODES))
+        if np.any(unknown):
+            print('Warning: unknown bases in ' + record.id + ' are treated as N; valid bases: ' + SEQ_CODES)
+            seq_codes = seq_codes.copy()
+            seq_codes[unknown] = SEQ_CODE_N
+        
+        seq_codes_dict[record.id] = seq_codes
     
-    return distal_seqs
+    return seq_codes_dict
+
+def get_digitalized_seq_codes(seq_codes_dict, bed_regions, distal_radius):
+    """
+    Same as get_digitalized_seq_ohe(), but each base is encoded as a uint8 code 
+    (position in SEQ_CODES), which is expanded to one-hot on the device later
+    """
+    return get_seq_code_windows(seq_codes_dict, bed_regions, distal_radius)
     
 
 def get_bw_for_bed(bw_files, bed_regions, radius):
@@ -482,10 +695,10 @@ def get_bw_for_bed(bw_files, bed_regions, radius):
     return bw_data
 
 def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only):
-    """Prepare local data for given regions"""
+    """Prepare local data for given regions; the local data cached by mural_train are used if present (never written here)"""
     
     # Read the seq data
-    local_seq_cat = get_digitalized_seq(ref_genome, bed_regions, local_radius, order=1)    
+    local_seq_cat = get_digitalized_seq_cached(ref_genome, bed_regions, local_radius, order=1, write_cache=False)    
     
     # Check whether the data is correctly extracted (e.g. not all sites are A/T; incorrect padding in the beginning of a chromosome)
     if np.unique(local_seq_cat[:,local_radius], axis=0).shape[0] != 1:
@@ -493,14 +706,14 @@ def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius
         sys.exit()
   
     # NOTE: replace negatives with 0, meaning replacing 'N' with 'A'
-    local_seq_cat = np.where(local_seq_cat>=0, local_seq_cat, 0)
+    local_seq_cat = np.maximum(local_seq_cat, 0, dtype=np.int32)
     
     # Assign column names and convert to DataFrame
     seq_cols = ['us'+str(local_radius - i) for i in range(local_radius)] + ['mid'] + ['ds'+str(i+1) for i in range(local_radius)]
     local_seq_cat = pd.DataFrame(local_seq_cat, columns = seq_cols)
     
     if local_order > 1:
-        local_seq_cat2 = get_digitalized_seq(ref_genome, bed_regions, local_radius, order=local_order)
+        local_seq_cat2 = get_digitalized_seq_cached(ref_genome, bed_regions, local_radius, order=local_order, write_cache=False)
         
         # NOTE: use np.int64 because nn.Embedding needs a Long type
         local_seq_cat2 = local_seq_cat2.astype(np.int64)
@@ -529,7 +742,7 @@ def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius
     # Add feature data in bigWig files
     if len(bw_files) > 0 and seq_only == False:
         # Use the mean value of the region of 2*radius+1 bp around the focal site
-        bw_data = get_mean_bw_for_bed(bw_files, bw_names, bed_regions, local_radius)
+        bw_data = get_mean_bw_for_bed_cached(bw_files, bw_names, bed_regions, local_radius, write_cache=False)
  
         data_local = pd.concat([local_seq_cat2, bw_data, y], axis=1)
     else:
@@ -589,6 +802,7 @@ class CombinedDatasetH5(Dataset):
         self.h5f_path = h5f_path
         self.h5f = None
         self.single_h5_size = 0
+        self.h5_slice = ()
         self.n_channels = n_channels
         print('Number of channels to be used for distal data:', self.n_channels)
         
@@ -602,18 +816,22 @@ class CombinedDatasetH5(Dataset):
         if self.h5f is None:
             
             # Open the H5 file once
-            self.h5f = h5py.File(self.h5f_path, 'r')
+            self.h5f = h5py.File(self.h5f_path, 'r', rdcc_nbytes=H5_RDCC_NBYTES, rdcc_nslots=H5_RDCC_NSLOTS)
             
             if len(self.h5f.keys()) > 1:
                 self.single_h5_size = self.h5f['distal_X1'].shape[0]
+            
+            # 2D datasets store uint8 seq codes, which have no channels to select
+            if self.h5f[list(self.h5f.keys())[0]].ndim == 3:
+                self.h5_slice = (slice(0, self.n_channels), slice(None))
             #print('open h5f file:', self.h5f_path)     
         if self.single_h5_size > 0:
             file_i = (idx // self.single_h5_size) + 1
             idx1 = idx % self.single_h5_size
-            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'+str(file_i)][idx1, 0:self.n_channels, :])
+            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'+str(file_i)][(idx1,) + self.h5_slice])
         
         else:
-            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'][idx, 0:self.n_channels, :])
+            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'][(idx,) + self.h5_slice])
     
     def get_labels(self): 
         return np.squeeze(self.y)
@@ -626,7 +844,7 @@ class CombinedDatasetH5(Dataset):
 
 class CombinedDatasetNP(Dataset):
     """Combine local data and distal into Dataset, using NumPy funcions"""
-    def __init__(self, data, seq_cols, cat_cols, output_col, ref_genome, bed_regions, distal_radius, n_channels, bw_files, seq_only):
+    def __init__(self, data, seq_cols, cat_cols, output_col, ref_genome, bed_regions, distal_radius, n_channels, bw_files, seq_only, seq_codes_dict=None):
         """  
         Args:
             data: DataFrame containing local seq data and categorical data
@@ -635,6 +853,7 @@ class CombinedDatasetNP(Dataset):
             output_col: name of the label column
             h5f_path: H5 file storing the distal data
             n_channels: number of columns (channels) in distal data to be extracted
+            seq_codes_dict: reference genome from get_seq_codes_dict(); read from ref_genome if None
         """
         # Store the local seq data and label for later use
         self.data_local = data[seq_cols+[output_col]]
@@ -691,39 +910,10 @@ class CombinedDatasetNP(Dataset):
         self.bed_pd = pd.read_csv(bed_regions.fn, sep='\t', header=None, memory_map=True)
         self.bed_pd.columns = ['chrom', 'start', 'stop', 'name', 'score', 'strand']
 
-        self.one_hot_encoder = {'A':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'C':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'G':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'T':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'R':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #C,T
-               'M':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #G,T
-               'B':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-        self.one_hot_encoder_rc = {'A':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'C':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'G':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'T':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'R':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #C,T
-               'M':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #G,T
-               'B':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-            
-        self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
+        # Reference genome as uint8 seq codes, possibly shared by all trials via the Ray object store
+        if seq_codes_dict is None:
+            seq_codes_dict = get_seq_codes_dict(ref_genome)
+        self.seq_codes = seq_codes_dict
         
 
     def __len__(self):
@@ -736,33 +926,28 @@ class CombinedDatasetNP(Dataset):
         region = self.bed_pd.iloc[idx]
         chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
         
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(self.records[chrom].seq)
+        long_seq = self.seq_codes[chrom]
         long_seq_len = len(long_seq)
 
         start1 = np.max([int(start)-self.distal_radius, 0])
         stop1 = np.min([int(stop)+self.distal_radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
+        short_seq = long_seq[start1:stop1]
 
         if(len(short_seq) < self.seq_len):
             #print('warning:', chrom, start1, stop1, long_seq_len)
+            pad_seq = np.full(self.seq_len - len(short_seq), SEQ_CODE_N, dtype=np.uint8)
             if start1 == 0:
-                short_seq = (self.seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
+                short_seq = np.concatenate([pad_seq, short_seq])
             else:
-                short_seq = short_seq + (self.seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
+                short_seq = np.concatenate([short_seq, pad_seq])
+        
         if strand == '+':
-            distal_seq = np.concatenate([self.one_hot_encoder[c] for c in short_seq], axis=1)
+            distal_seq = np.ascontiguousarray(SEQ_CODE_OHE[short_seq].T)
         else:
-            #a = [one_hot_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            distal_seq = np.concatenate([self.one_hot_encoder_rc[c] for c in short_seq[::-1]], axis=1)
+            distal_seq = np.ascontiguousarray(SEQ_CODE_OHE_RC[short_seq[::-1]].T)
         if distal_seq.shape[1] != self.seq_len:
             print('distal_seq.shape:', distal_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
+            print('short_seq:', ''.join([SEQ_CODES[c] for c in short_seq]))
 
         # Handle distal bigWig data
         if len(self.bw_fh) > 0 and self.seq_only == False:
@@ -788,11 +973,11 @@ class CombinedDatasetNP(Dataset):
     def _get_labels(self, dataset, idx):
         return dataset.__getitem__(idx)[1]
 
-def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1):
+def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1, seq_codes=False, h5_chunk_size=1, compression=H5_COMPRESSION_DEFAULT):
     """Prepare the datasets for given regions, using H5 file"""
  
     # Generate H5 file for distal data
-    generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size, n_h5_files)
+    generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size, n_h5_files, seq_codes=seq_codes, h5_chunk_size=h5_chunk_size, compression=compression)
     
     # Prepare local data
     data_local, seq_cols, categorical_features, output_feature = prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only)
@@ -811,7 +996,7 @@ def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, lo
     return dataset
 
 
-def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1,seq_only=False):
+def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1,seq_only=False, seq_codes_dict=None):
     """Prepare the datasets for given regions, without an H5 file"""
     
     # Prepare local data
@@ -825,6 +1010,6 @@ def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius
         n_channels = 4**distal_order + len(bw_files)
     
     # Combine local data and distal into Dataset objects  
-    dataset = CombinedDatasetNP(data=data_local, seq_cols=seq_cols, cat_cols=categorical_features, output_col=output_feature, ref_genome=ref_genome, bed_regions=bed_regions, distal_radius=distal_radius, n_channels=n_channels, bw_files=bw_files, seq_only=seq_only)
+    dataset = CombinedDatasetNP(data=data_local, seq_cols=seq_cols, cat_cols=categorical_features, output_col=output_feature, ref_genome=ref_genome, bed_regions=bed_regions, distal_radius=distal_radius, n_channels=n_channels, bw_files=bw_files, seq_only=seq_only, seq_codes_dict=seq_codes_dict)
     #return dataset, data_local, categorical_features
     return dataset
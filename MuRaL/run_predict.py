@@ -30,7 +30,6 @@ from pynvml import *
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.benchmark = True
-torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.allow_tf32 = True
 
 def parse_arguments(parser):
@@ -87,6 +86,20 @@ def parse_arguments(parser):
                           Only use CPU computing. Default: False.
                           """).strip())
         
+    optional.add_argument('--bf16', default=False, action='store_true',  
+                          help=textwrap.dedent("""
+                          Run the model forward pass under bfloat16 autocast, which is
+                          faster on GPUs/CPUs supporting bfloat16; the output probabilities
+                          are still computed in FP32. Default: False.
+                          """).strip())
+        
+    optional.add_argument('--int8', default=False, action='store_true',  
+                          help=textwrap.dedent("""
+                          Quantize the distal CNN layers to INT8 for faster CPU
+                          prediction (with '--cpu_only'). A few batches of the input
+                          data are used for calibration. Default: False.
+                          """).strip())
+        
     optional.add_argument('--pred_batch_size', metavar='INT', default=16, 
                           help=textwrap.dedent("""
                           Size of mini batches for prediction. Default: 16.
@@ -224,6 +237,7 @@ def main():
     n_class = config['n_class']
     model_no = config['model_no']
     seq_only = config['seq_only']
+    share_distal_cnn = config.get('share_distal_cnn', False)
    
     
     start_time = time.time()
@@ -258,7 +272,8 @@ def main():
         print('using prepare_dataset_np ...')
     else:
 
-        dataset_test = prepare_dataset_h5(test_bed, ref_genome, bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, test_h5f_path, 5000, seq_only, n_h5_files)
+        # Test data are read in order, so that larger HDF5 chunks reduce the number of reads
+        dataset_test = prepare_dataset_h5(test_bed, ref_genome, bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, test_h5f_path, 5000, seq_only, n_h5_files, h5_chunk_size=max(1, int(pred_batch_size)), compression=H5_COMPRESSION_DEFAULT)
         
         #prepare_dataset_h5(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', h5_chunk_size=1, seq_only=False, n_h5_files=1)
             
@@ -287,13 +302,19 @@ def main():
             print('using'  , 'cuda:'+cuda_id)
         device = torch.device('cuda:'+cuda_id if torch.cuda.is_available() else 'cpu')
     
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        # Same as allow_tf32 for matmuls, in the API of newer PyTorch versions
+        torch.set_float32_matmul_precision('high')
+    # Deterministic algorithms would override the benchmark autotuning
+    torch.backends.cudnn.deterministic = False
+    
     # Choose the network model
     if model_no == 0:
         model = Network0(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], n_class=n_class, emb_padding_idx=4**local_order).to(device)
     elif model_no == 1:
-        model = Network1(in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class).to(device)
+        model = Network1(in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, share_distal_cnn=share_distal_cnn).to(device)
     elif model_no == 2:
-        model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order).to(device)
+        model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order, share_distal_cnn=share_distal_cnn).to(device)
     elif model_no == 10:
         model = Network10(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order).to(device)
     elif model_no == 11:
@@ -310,19 +331,35 @@ def main():
     model.load_state_dict(model_state)
     
     del model_state
-    torch.cuda.empty_cache() 
+    torch.cuda.empty_cache()
 
-    # Loss function
-    criterion = torch.nn.CrossEntropyLoss(reduction='sum')
+    model.eval()
     
-    # Set prob names for mutation types
-    prob_names = ['prob'+str(i) for i in range(n_class)]
-
     # Dataloader for testing data    
     if cpu_only:
         dataloader = DataLoader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)
     else:
         dataloader = DataLoader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)   
+    
+    if args.int8 and device == torch.device('cpu') and model_no in (1, 2):
+        # Fold BatchNorm layers into the convolutions first, so that they are quantized together
+        model = to_inference(model)
+        model = quantize_distal_cnn(model, dataloader)
+    else:
+        if args.int8:
+            print('Warning: --int8 is only used for CPU prediction with model_no 1 or 2; ignored.')
+        
+        # Fold BatchNorm layers and remove Dropout layers, as the model is only used for prediction
+        model = to_inference(model)
+    
+    if args.bf16:
+        model.amp_dtype = torch.bfloat16
+
+    # Loss function
+    criterion = torch.nn.CrossEntropyLoss(reduction='sum')
+    
+    # Set prob names for mutation types
+    prob_names = ['prob'+str(i) for i in range(n_class)]
 
     # Do the prediction
     pred_y, test_total_loss = model_predict_m(model, dataloader, criterion, device, n_class, distal=True)
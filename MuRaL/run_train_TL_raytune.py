@@ -37,7 +37,6 @@ from ray.tune.schedulers import ASHAScheduler
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.benchmark = True
-torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.allow_tf32 = True
 
 def parse_arguments(parser):
@@ -460,6 +459,7 @@ def main():
         'train_all': train_all,
         'init_fc_with_pretrained': init_fc_with_pretrained,
         'emb_dims':emb_dims,
+        'share_distal_cnn': config.get('share_distal_cnn', False),
     }
     
     # Set the scheduler for parallel training 
@@ -3,21 +3,9 @@ Code for training models with RayTune
 """
 
 import warnings
-warnings.filterwarnings('ignore',category=FutureWarning)
-
-from pybedtools import BedTool
 
 import sys
 import argparse
-import pandas as pd
-import numpy as np
-import pickle
-
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
-from torch.utils.data import random_split
 
 #torch.backends.cuda.matmul.allow_tf32 = True
 #torch.backends.cudnn.benchmark = True
@@ -25,21 +13,16 @@ from torch.utils.data import random_split
 #torch.backends.cudnn.allow_tf32 = True
 
 from functools import partial
-import ray
-from ray import tune
-from ray.tune import CLIReporter
-from ray.tune.schedulers import ASHAScheduler
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import shutil
+import tempfile
 
 import os
 import time
 import datetime
 import random
 
-from MuRaL.nn_models import *
-from MuRaL.nn_utils import *
-from MuRaL.preprocessing import *
-from MuRaL.evaluation import *
-from MuRaL.training import *
 from MuRaL._version import __version__
 
 import textwrap
@@ -112,6 +95,26 @@ def parse_arguments(parser):
                           help=textwrap.dedent("""
                           Number of HDF5 files for each BED file. Default: 1. """ ).strip())
     
+    data_args.add_argument('--h5_compression', type=str, metavar='STR', default=None, choices=['gzip', 'lzf', 'none'],
+                          help=textwrap.dedent("""
+                          Compression of newly generated HDF5 files: 'gzip', 'lzf' 
+                          (faster to read) or 'none'. Default: the same as the 
+                          --compression default of gen_distal_h5.""").strip())
+    
+    data_args.add_argument('--h5_chunk_size', type=int, metavar='INT', default=1, 
+                          help=textwrap.dedent("""
+                          Number of sites per HDF5 chunk for the training data, which
+                          is read in random order. HDF5 files of the validation data 
+                          (read in order) use chunks of the largest batch size. 
+                          Default: 1.""").strip())
+    
+    data_args.add_argument('--seq_codes', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Store distal sequences in HDF5 files as uint8 base codes,
+                          which are expanded to one-hot encoding on the device. Only
+                          used with distal_order 1 and without bigWig tracks (or 
+                          with --seq_only). Default: False.""").strip())
+    
     data_args.add_argument('--save_valid_preds', default=False, action='store_true', 
                           help=textwrap.dedent("""
                           Save prediction results for validation data in the checkpoint
@@ -189,6 +192,13 @@ def parse_arguments(parser):
                           Default: 0.25.
                            """ ).strip())
     
+    model_args.add_argument('--share_distal_cnn', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Share the convolutional layers between the two branches of the 
+                          expanded module (only pooling sizes and FC layers differ), which 
+                          halves their parameters. Default: False.
+                          """).strip())
+    
     learn_args.add_argument('--batch_size', type=int, metavar='INT', default=[128], nargs='+', 
                           help=textwrap.dedent("""
                           Size of mini batches for model training. Default: 128.
@@ -250,12 +260,62 @@ def parse_arguments(parser):
                            Default: 0.5.
                            """ ).strip())
 
+    learn_args.add_argument('--dataloader_workers', type=int, metavar='INT', default=-1, 
+                          help=textwrap.dedent("""
+                          Number of DataLoader worker processes for training data.
+                          Default: -1 (i.e. '--cpu_per_trial' minus 1).
+                          """).strip())
+    
+    learn_args.add_argument('--prefetch_factor', type=int, metavar='INT', default=4, 
+                          help=textwrap.dedent("""
+                          Number of batches loaded in advance by each DataLoader
+                          worker. Default: 4.
+                          """).strip())
+    
+    learn_args.add_argument('--pin_memory_false', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          If set, don't use pinned (page-locked) memory for batches 
+                          copied to the GPU. Default: not set.
+                          """).strip())
+    
+    learn_args.add_argument('--compile_model', type=str, metavar='STR', default='none', nargs='?', const='reduce-overhead',
+                          choices=['none', 'default', 'reduce-overhead', 'max-autotune'],
+                          help=textwrap.dedent("""
+                          Compile the model with torch.compile (PyTorch>=2.0) for training,
+                          using the given mode: 'none', 'default', 'reduce-overhead' or 
+                          'max-autotune'; 'reduce-overhead' if no mode is given. The
+                          last incomplete batch of each epoch is dropped to keep shapes 
+                          fixed. Default: 'none'.
+                          """).strip())
+    
+    learn_args.add_argument('--amp', type=str, metavar='STR', default='off', choices=['off', 'fp16', 'bf16'],
+                          help=textwrap.dedent("""
+                          Automatic mixed precision for training: 'off', 'fp16' (CUDA 
+                          only, with gradient scaling) or 'bf16'. Default: 'off'.
+                          """).strip())
+    
+    learn_args.add_argument('--auto_batch_size', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          If set, each trial splits its training batches into smaller 
+                          ones if a batch does not fit in the GPU memory (or in the
+                          share of '--gpu_per_trial' for fractional GPUs), and 
+                          accumulates their gradients, keeping the effective batch 
+                          size. Default: not set.
+                          """).strip())
+    
     learn_args.add_argument('--cudnn_benchmark_false', default=False, action='store_true', 
                           help=textwrap.dedent("""
                           If set, torch.backends.cudnn.benchmark will be False. 
                           Default: not set.
                           """).strip())
     
+    learn_args.add_argument('--deterministic', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          If set, use deterministic cuDNN algorithms for reproducible
+                          training (also sets torch.backends.cudnn.benchmark to False),
+                          which can be slower. Default: not set.
+                          """).strip())
+    
     raytune_args.add_argument('--experiment_name', type=str, metavar='STR', default='my_experiment',
                           help=textwrap.dedent("""
                           Ray-Tune experiment name.  Default: 'my_experiment'.
@@ -283,6 +343,15 @@ def parse_arguments(parser):
                           Default: 'loss'.
                           """ ).strip())
     
+    raytune_args.add_argument('--search_alg', type=str, metavar='STR', default='random', choices=['random', 'bohb', 'optuna'],
+                          help=textwrap.dedent("""
+                          Search algorithm for hyperparameters: 'random' (random 
+                          search with ASHA scheduling), 'bohb' (TuneBOHB with 
+                          HyperBandForBOHB scheduling; requires hpbandster and 
+                          ConfigSpace) or 'optuna' (OptunaSearch with ASHA 
+                          scheduling; requires optuna). Default: 'random'.
+                          """ ).strip())
+    
     raytune_args.add_argument('--ray_ncpus', type=int, metavar='INT', default=2, 
                           help=textwrap.dedent("""
                           Number of CPUs requested by Ray-Tune. Default: 2.
@@ -303,6 +372,20 @@ def parse_arguments(parser):
                           Number of GPUs used per trial. Default: 0.15.
                           """ ).strip())
     
+    raytune_args.add_argument('--workers_per_trial', type=int, metavar='INT', default=1, 
+                          help=textwrap.dedent("""
+                          Number of data-parallel workers (DistributedDataParallel) per trial.
+                          If >1, each worker uses '--cpu_per_trial' CPUs and, if GPUs are used,
+                          one whole GPU, and batch size is per worker. Default: 1.
+                          """ ).strip())
+    
+    raytune_args.add_argument('--ray_shm', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Put Ray's temp folder and object store (plasma) in /dev/shm,
+                          with an object store of min(30%% of available RAM, 32 GB).
+                          Default: False.
+                          """ ).strip())
+    
     raytune_args.add_argument('--cuda_id', type=str, metavar='STR', default=None, 
                           help=textwrap.dedent("""
                           Which GPU device to be used. Default: '0'. 
@@ -324,6 +407,7 @@ def parse_arguments(parser):
         args = parser.parse_args()
 
     return args
+
 def main():
     
     #parse the command line
@@ -427,6 +511,19 @@ def main():
     """)
     
     args = parse_arguments(parser)
+    
+    # Heavy modules are imported after parsing the arguments, so that e.g. '--help' returns quickly
+    warnings.filterwarnings('ignore',category=FutureWarning)
+    
+    import pandas as pd
+    import torch
+    import ray
+    from ray import tune
+    from ray.tune import CLIReporter
+    from ray.tune.schedulers import ASHAScheduler
+    
+    from MuRaL.preprocessing import BedFrame, get_h5f_path, generate_h5fv2, stage_h5f, get_digitalized_seq_cached, get_mean_bw_for_bed_cached, get_seq_codes_dict, H5_COMPRESSION_DEFAULT
+    from MuRaL.training import train, tune_choice, get_grid_size, UniqueConfigSearcher, get_split_indices
 
     print(' '.join(sys.argv)) # print the command line
     for k,v in vars(args).items():
@@ -475,6 +572,7 @@ def main():
     n_trials = args.n_trials
     experiment_name = args.experiment_name
     ASHA_metric = args.ASHA_metric
+    search_alg = args.search_alg
     n_class = args.n_class  
     cuda_id = args.cuda_id
     valid_ratio = args.valid_ratio
@@ -484,6 +582,7 @@ def main():
     ray_ngpus = args.ray_ngpus
     cpu_per_trial = args.cpu_per_trial
     gpu_per_trial = args.gpu_per_trial
+    workers_per_trial = args.workers_per_trial
     
     if args.split_seed < 0:
         args.split_seed = random.randint(0, 1000000)
@@ -508,32 +607,65 @@ def main():
     else:
         print('NOTE: no bigWig files provided.')
     
-    # Prepare min/max for the loguniform samplers if one value is provided
-    if len(learning_rate) == 1:
-        learning_rate = learning_rate*2
-    if len(weight_decay) == 1:
-        weight_decay = weight_decay*2
+    if args.seq_codes and (distal_order != 1 or (len(bw_files) > 0 and not args.seq_only)):
+        print('Warning: --seq_codes requires distal_order 1 and no bigWig tracks (or --seq_only); using one-hot encoding in H5 files.')
+        args.seq_codes = False
+    seq_codes = args.seq_codes
     
-    # Read the train datapoints
-    train_bed = BedTool(train_file)
+    # Read the train datapoints (only the file name and size are needed here)
+    train_bed = BedFrame(train_file)
     
     # Generate H5 files for storing distal regions before training, one file for each possible distal radius
+    # Keyed by the H5 file path, so that each file has only one writer
+    h5_jobs = {}
     for d_radius in distal_radius:
-        h5f_path = get_h5f_path(train_file, bw_names, d_radius, distal_order)
-        if not args.without_h5:
-            generate_h5fv2(train_bed, h5f_path, ref_genome, d_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files)
-            #generate_h5fv2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
+        h5f_path = get_h5f_path(train_file, [] if seq_codes else bw_names, d_radius, distal_order, seq_codes)
+        h5_jobs[h5f_path] = (train_bed, d_radius, args.h5_chunk_size)
+        #generate_h5fv2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
     
     if valid_file:
-        valid_bed = BedTool(valid_file)
+        valid_bed = BedFrame(valid_file)
         for d_radius in distal_radius:
-            valid_h5f_path = get_h5f_path(valid_file, bw_names, d_radius, distal_order)
-            if not args.without_h5:
-                generate_h5fv2(valid_bed, valid_h5f_path, ref_genome, d_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files)
-    
+            valid_h5f_path = get_h5f_path(valid_file, [] if seq_codes else bw_names, d_radius, distal_order, seq_codes)
+            h5_jobs[valid_h5f_path] = (valid_bed, d_radius, max(batch_size))
+    
+    if not args.without_h5:
+        # Each H5 file is written by separate gen_distal_h5 process(es), so threads are enough to run them concurrently
+        n_workers = max(1, min(len(h5_jobs), ray_ncpus//max(1, n_h5_files)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(generate_h5fv2, bed, h5f_path, ref_genome, d_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files, seq_codes=seq_codes, h5_chunk_size=h5_chunk_size, compression=args.h5_compression or H5_COMPRESSION_DEFAULT) for h5f_path, (bed, d_radius, h5_chunk_size) in h5_jobs.items()]
+            for future in futures:
+                future.result()
+        
+        # Optionally stage H5 files in shared memory (RAM), which are then read by all trials
+        if os.environ.get('MURAL_USE_SHM') == '1':
+            if len(set(os.path.basename(h5f_path) for h5f_path in h5_jobs)) < len(h5_jobs):
+                print('Warning: MURAL_USE_SHM=1, but H5 file names are not unique; using H5 files on disk.')
+            elif os.path.isdir('/dev/shm'):
+                shm_dir = tempfile.mkdtemp(prefix='mural_h5_', dir='/dev/shm')
+                atexit.register(shutil.rmtree, shm_dir, True)
+                
+                for h5f_path in h5_jobs:
+                    stage_h5f(h5f_path, shm_dir)
+                args.h5_override_dir = shm_dir
+                print('NOTE: MURAL_USE_SHM=1, using H5 files staged in', shm_dir)
+            else:
+                print('Warning: MURAL_USE_SHM=1, but /dev/shm is not available; using H5 files on disk.')
+    
+    
+    # Encode the local sequences and extract the local bigWig features once for all trials (cached next to the BED files)
+    local_beds = [train_bed] + ([valid_bed] if valid_file else [])
+    seq_codes_dict = {}
+    for bed in local_beds:
+        for l_radius in set(local_radius):
+            for l_order in set([1] + list(local_order)):
+                get_digitalized_seq_cached(ref_genome, bed, l_radius, l_order, seq_codes_dict=seq_codes_dict)
+            
+            if len(bw_files) > 0 and not args.seq_only:
+                get_mean_bw_for_bed_cached(bw_files, bw_names, bed, l_radius)
     
     ####
-    if cuda_id == None and ray_ngpus > 0:
+    if cuda_id == None and ray_ngpus > 0 and workers_per_trial == 1:
         from pynvml import nvmlInit, nvmlDeviceGetCount, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
         # Find a GPU with enough memory
         nvmlInit()
@@ -556,10 +688,13 @@ def main():
         if not torch.cuda.is_available():
             print('Error: You requested GPU computing, but CUDA is not available! If you want to run without GPU, please set "--ray_ngpus 0 --gpu_per_trial 0"', file=sys.stderr)
             sys.exit()
-        # Set visible GPU(s)
-        os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-        os.environ["CUDA_VISIBLE_DEVICES"] = cuda_id
-        print('Ray is using GPU device', 'cuda:'+cuda_id)
+        if cuda_id != None:
+            # Set visible GPU(s)
+            os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+            os.environ["CUDA_VISIBLE_DEVICES"] = cuda_id
+            print('Ray is using GPU device', 'cuda:'+cuda_id)
+        else:
+            print('Ray is using all visible GPU devices')
     else:
         print('Ray is using only CPUs ...')
     
@@ -570,51 +705,114 @@ def main():
         resume_flag = False
     
     # Allocate CPU/GPU resources for this Ray job
-    ray.init(num_cpus=ray_ncpus, num_gpus=ray_ngpus, dashboard_host="0.0.0.0")
+    ray_kwargs = {}
+    if args.ray_shm:
+        # RAM-backed object store, so that shared objects (e.g. the reference genome) are not spilled to disk
+        available_ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        object_store_memory = int(min(available_ram*0.3, 32*1024**3))
+        
+        if not os.path.isdir('/dev/shm'):
+            print('Error: --ray_shm was set, but /dev/shm is not available!', file=sys.stderr)
+            sys.exit()
+        shm_free = shutil.disk_usage('/dev/shm').free
+        if shm_free < object_store_memory:
+            print('Error: --ray_shm was set, but /dev/shm has only', shm_free, 'bytes free;', object_store_memory, 'bytes are needed for the object store!', file=sys.stderr)
+            sys.exit()
+        
+        ray_kwargs = {'_temp_dir': '/dev/shm/ray', '_plasma_directory': '/dev/shm', 'object_store_memory': object_store_memory}
+        print('NOTE: Ray is using /dev/shm, object_store_memory:', object_store_memory)
+    
+    ray.init(num_cpus=ray_ncpus, num_gpus=ray_ngpus, dashboard_host="0.0.0.0", **ray_kwargs)
     #ray.init(num_cpus=ray_ncpus, num_gpus=ray_ngpus)
     
+    # Without H5 files, trials extract distal seqs from the reference genome; read it 
+    # only once and share it with all trials via the Ray object store
+    if args.without_h5:
+        args.ref_handle = ray.put(seq_codes_dict or get_seq_codes_dict(ref_genome))
+    del seq_codes_dict
+    
+    # Split the training data only once for all trials
+    if not valid_file:
+        args.split_handle = ray.put(get_split_indices(len(train_bed), valid_ratio, args.split_seed))
+    
     sys.stdout.flush()
     
-    # Configure the search space for relavant hyperparameters
+    # Configure the search space for relavant hyperparameters; parameters with one value are constants
     config = {
-        'local_radius': tune.choice(local_radius),
-        'local_order': tune.choice(local_order),
-        'local_hidden1_size': tune.choice(local_hidden1_size),
-        #'local_hidden2_size': tune.choice(local_hidden2_size),
-        'local_hidden2_size': tune.choice(local_hidden2_size) if local_hidden2_size[0]>0 else tune.sample_from(lambda spec: spec.config.local_hidden1_size//2), # default local_hidden2_size = local_hidden1_size//2
-        'distal_radius': tune.choice(distal_radius),
-        'emb_dropout': tune.choice(emb_dropout),
-        'local_dropout': tune.choice(local_dropout),
-        'CNN_kernel_size': tune.choice(CNN_kernel_size),
-        'CNN_out_channels': tune.choice(CNN_out_channels),
-        'distal_fc_dropout': tune.choice(distal_fc_dropout),
-        'batch_size': tune.choice(batch_size),
-        'learning_rate': tune.loguniform(learning_rate[0], learning_rate[1]),
+        'local_radius': tune_choice(local_radius),
+        'local_order': tune_choice(local_order),
+        'local_hidden1_size': tune_choice(local_hidden1_size),
+        # default local_hidden2_size (0) = local_hidden1_size//2, which is resolved in train()
+        'local_hidden2_size': tune_choice(local_hidden2_size) if local_hidden2_size[0]>0 else 0,
+        'distal_radius': tune_choice(distal_radius),
+        'emb_dropout': tune_choice(emb_dropout),
+        'local_dropout': tune_choice(local_dropout),
+        'CNN_kernel_size': tune_choice(CNN_kernel_size),
+        'CNN_out_channels': tune_choice(CNN_out_channels),
+        'distal_fc_dropout': tune_choice(distal_fc_dropout),
+        'batch_size': tune_choice(batch_size),
+        'learning_rate': tune.loguniform(learning_rate[0], learning_rate[1]) if len(learning_rate) > 1 else learning_rate[0],
         #'learning_rate': tune.choice(learning_rate),
-        'optim': tune.choice(optim),
-        'lr_scheduler':tune.choice(lr_scheduler),
-        'LR_gamma': tune.choice(LR_gamma),
-        'weight_decay': tune.loguniform(weight_decay[0], weight_decay[1]),
+        'optim': tune_choice(optim),
+        'lr_scheduler':tune_choice(lr_scheduler),
+        'LR_gamma': tune_choice(LR_gamma),
+        'weight_decay': tune.loguniform(weight_decay[0], weight_decay[1]) if len(weight_decay) > 1 else weight_decay[0],
 
         #'weight_decay': tune.choice(weight_decay),
+        'share_distal_cnn': args.share_distal_cnn,
         'transfer_learning': False,
     }
     
+    # Don't run more trials than there are distinct configs
+    grid_size = get_grid_size(config)
+    if grid_size is not None and n_trials > grid_size:
+        print('NOTE: the search space has only', grid_size, 'distinct configs; running', grid_size, 'trials instead of', n_trials)
+        n_trials = grid_size
+    
 
     # Set the scheduler for parallel training 
-    scheduler = ASHAScheduler(
-    #metric='loss',
-    metric=ASHA_metric, # Use a metric for model selection
-    mode='min',
-    max_t=epochs,
-    grace_period=grace_period,
-    reduction_factor=2)
+    if search_alg == 'bohb':
+        from ray.tune.schedulers import HyperBandForBOHB
+        from ray.tune.suggest.bohb import TuneBOHB
+        
+        # Model-based search, with a HyperBand scheduler matching BOHB's brackets
+        searcher = TuneBOHB(metric=ASHA_metric, mode='min')
+        scheduler = HyperBandForBOHB(
+        time_attr='training_iteration',
+        metric=ASHA_metric,
+        mode='min',
+        max_t=epochs,
+        reduction_factor=2)
+    else:
+        if search_alg == 'optuna':
+            from ray.tune.suggest.optuna import OptunaSearch
+            searcher = OptunaSearch(metric=ASHA_metric, mode='min')
+        else:
+            # Random search without duplicated configs
+            searcher = UniqueConfigSearcher(metric=ASHA_metric, mode='min')
+        
+        scheduler = ASHAScheduler(
+        #metric='loss',
+        metric=ASHA_metric, # Use a metric for model selection
+        mode='min',
+        max_t=epochs,
+        grace_period=grace_period,
+        reduction_factor=2)
     
     # Information to be shown in the progress table
     reporter = CLIReporter(parameter_columns=['local_radius', 'local_order', 'local_hidden1_size', 'local_hidden2_size', 'distal_radius', 'emb_dropout', 'local_dropout', 'CNN_kernel_size', 'CNN_out_channels', 'distal_fc_dropout', 'optim', 'learning_rate', 'weight_decay', 'LR_gamma', 'batch_size'], metric_columns=['loss', 'fdiri_loss', 'after_min_loss',  'score', 'total_params', 'training_iteration'])
     
     trainable_id = 'Train'
-    tune.register_trainable(trainable_id, partial(train, args=args))
+    if workers_per_trial > 1:
+        from ray.tune.integration.torch import DistributedTrainableCreator
+        
+        # Each trial runs on multiple workers with DistributedDataParallel; resources are set per worker
+        trainable = DistributedTrainableCreator(partial(train, args=args), use_gpu=gpu_per_trial > 0, num_workers=workers_per_trial, num_cpus_per_worker=cpu_per_trial, backend='nccl' if gpu_per_trial > 0 else 'gloo')
+        resources_per_trial = None
+    else:
+        trainable = partial(train, args=args)
+        resources_per_trial = {'cpu': 1, 'gpu': gpu_per_trial, 'extra_cpu':cpu_per_trial-1}
+    tune.register_trainable(trainable_id, trainable)
     
     def trial_dirname_string(trial):
         return "{}_{}".format(trial.trainable_name, trial.trial_id)
@@ -623,11 +821,12 @@ def main():
     result = tune.run(
     trainable_id,
     name=experiment_name,
-    resources_per_trial={'cpu': 1, 'gpu': gpu_per_trial, 'extra_cpu':cpu_per_trial-1},
+    resources_per_trial=resources_per_trial,
     config=config,
     num_samples=n_trials,
     local_dir='./ray_results',
     trial_dirname_creator=trial_dirname_string,
+    search_alg=searcher,
     scheduler=scheduler,
     stop={'after_min_loss':3},
     progress_reporter=reporter,
@@ -13,11 +13,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
-from torch.utils.data import random_split
+from torch.utils.data import Subset
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.benchmark = True
-torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.allow_tf32 = True
 
 from functools import partial
@@ -25,6 +27,9 @@ import ray
 from ray import tune
 from ray.tune import CLIReporter
 from ray.tune.schedulers import ASHAScheduler
+from ray.tune.integration.torch import distributed_checkpoint_dir
+from ray.tune.suggest import Searcher
+from ray.tune.sample import Domain, Categorical
 
 import os
 import time
@@ -38,6 +43,128 @@ from MuRaL.evaluation import *
 
 #from torchsampler import ImbalancedDatasetSampler
 
+def tune_choice(values):
+    """tune.choice() over the values, or the value itself if only one value is given (not searched)"""
+    values = list(values)
+    
+    return values[0] if len(values) == 1 else tune.choice(values)
+
+def get_grid_size(config):
+    """Number of distinct configs in a search space, or None if it has non-categorical (e.g. continuous) parameters"""
+    grid_size = 1
+    for value in config.values():
+        if isinstance(value, Categorical):
+            grid_size *= len(set(value.categories))
+        elif isinstance(value, Domain):
+            return None
+    
+    return grid_size
+
+class UniqueConfigSearcher(Searcher):
+    """
+    Random search that does not suggest the same config twice
+    
+    A config is re-sampled on a collision, up to max_retries times. The search
+    finishes when no new config is found, e.g. when all combinations of a small 
+    categorical search space have been suggested.
+    """
+    def __init__(self, metric=None, mode=None, max_retries=100):
+        super(UniqueConfigSearcher, self).__init__(metric=metric, mode=mode)
+        self.max_retries = max_retries
+        self.space = {}
+        self.seen = set()
+    
+    def set_search_properties(self, metric, mode, config):
+        self.space = config
+        return True
+    
+    def suggest(self, trial_id):
+        grid_size = get_grid_size(self.space)
+        if grid_size is None or len(self.seen) < grid_size:
+            for i in range(self.max_retries):
+                config = {key:(value.sample() if isinstance(value, Domain) else value) for key, value in self.space.items()}
+                config_key = tuple(sorted((key, repr(value)) for key, value in config.items()))
+                
+                if config_key not in self.seen:
+                    self.seen.add(config_key)
+                    return config
+        
+        return Searcher.FINISHED
+    
+    def on_trial_complete(self, trial_id, result=None, error=False):
+        pass
+    
+    def save(self, checkpoint_path):
+        with open(checkpoint_path, 'wb') as f:
+            pickle.dump(self.seen, f)
+    
+    def restore(self, checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            self.seen = pickle.load(f)
+
+def get_split_indices(n_samples, valid_ratio, split_seed):
+    """
+    Randomly split range(n_samples) into training and validation indices, the same way 
+    as random_split() with torch.Generator().manual_seed(split_seed); the validation 
+    indices are sorted
+    """
+    valid_size = int(n_samples*valid_ratio)
+    indices = torch.randperm(n_samples, generator=torch.Generator().manual_seed(split_seed)).numpy()
+    
+    return indices[:n_samples-valid_size], np.sort(indices[n_samples-valid_size:])
+
+def _probe_batch_memory(model, criterion, batch, device, amp_dtype):
+    """Peak GPU memory of a forward and backward pass of the model on a batch"""
+    torch.cuda.reset_peak_memory_stats(device)
+    
+    y, cont_x, cat_x, distal_x = [t.to(device) for t in batch]
+    if distal_x.dtype == torch.uint8:
+        distal_x = expand_seq_codes(distal_x)
+    
+    with autocast_context(device.type, amp_dtype):
+        preds = model((cont_x, cat_x), distal_x)
+        loss = criterion(preds, y.long().squeeze(1))
+    loss.backward()
+    
+    return torch.cuda.max_memory_allocated(device)
+
+def find_max_batch_size(model, criterion, batch, device, amp_dtype=None, mem_fraction=1.0):
+    """
+    Find the largest part of a training batch that fits in the GPU memory
+    
+    The batch is split into 1, 2, 4, ... parts until a forward and backward pass on 
+    one part neither runs out of memory nor uses more than mem_fraction of the GPU 
+    memory. The model state (e.g. BatchNorm statistics) is restored afterwards.
+    
+    Returns:
+        The size of the parts and the number of parts
+    """
+    batch_size = batch[0].shape[0]
+    model_state = {key: value.detach().clone() for key, value in model.state_dict().items()}
+    max_memory = mem_fraction*torch.cuda.get_device_properties(device).total_memory
+    
+    accum_steps = 1
+    while True:
+        part_size = -(-batch_size//accum_steps)
+        try:
+            fits = _probe_batch_memory(model, criterion, [t[:part_size] for t in batch], device, amp_dtype) <= max_memory
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError (PyTorch>=1.13) is a RuntimeError
+            if 'out of memory' not in str(e):
+                raise
+            fits = False
+        
+        model.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+        
+        if fits or part_size == 1:
+            break
+        accum_steps *= 2
+    
+    model.load_state_dict(model_state)
+    
+    return part_size, -(-batch_size//part_size)
+
 
 def train(config, args, checkpoint_dir=None):
     """
@@ -87,15 +214,35 @@ def train(config, args, checkpoint_dir=None):
     gpu_per_trial = args.gpu_per_trial
     cpu_per_trial = args.cpu_per_trial
     save_valid_preds = args.save_valid_preds
+    compile_model = getattr(args, 'compile_model', 'none')
+    if compile_model in (True, False):
+        compile_model = 'reduce-overhead' if compile_model else 'none'
+    h5_override_dir = getattr(args, 'h5_override_dir', None) # folder with staged copies of the H5 files
+    seq_codes = getattr(args, 'seq_codes', False) # store distal seqs as uint8 codes in H5 files
+    ref_handle = getattr(args, 'ref_handle', None) # reference genome in the Ray object store
+    split_handle = getattr(args, 'split_handle', None) # training/validation indices in the Ray object store
+    amp = getattr(args, 'amp', 'off')
+    auto_batch_size = getattr(args, 'auto_batch_size', False)
     
     bw_paths = args.bw_paths
     bw_files = []
     bw_names = []
     
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        # Same as allow_tf32 for matmuls, in the API of newer PyTorch versions (set per trial, not at import)
+        torch.set_float32_matmul_precision('high')
+    
     if cudnn_benchmark_false:
         torch.backends.cudnn.benchmark = False
         print('NOTE: setting torch.backends.cudnn.benchmark = False')
     
+    # Deterministic algorithms would override the benchmark autotuning, so they are only used with '--deterministic'
+    torch.backends.cudnn.deterministic = False
+    if getattr(args, 'deterministic', False):
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+        print('NOTE: using deterministic cuDNN algorithms (torch.backends.cudnn.benchmark = False)')
+    
     if bw_paths:
         try:
             bw_list = pd.read_table(bw_paths, sep='\s+', header=None, comment='#')
@@ -109,15 +256,21 @@ def train(config, args, checkpoint_dir=None):
     # Read BED files
     train_bed = BedTool(train_file)
     
+    seq_codes_dict = None
+    if without_h5 and ref_handle is not None:
+        seq_codes_dict = ray.get(ref_handle)
+    
     if without_h5:
-        dataset = prepare_dataset_np(train_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only)
+        dataset = prepare_dataset_np(train_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only, seq_codes_dict=seq_codes_dict)
         print('using numpy/pandas for distal_seq ...')
     else:
         # Get the H5 file path
-        train_h5f_path = get_h5f_path(train_file, bw_names, config['distal_radius'], distal_order)
+        train_h5f_path = get_h5f_path(train_file, [] if seq_codes else bw_names, config['distal_radius'], distal_order, seq_codes)
+        if h5_override_dir:
+            train_h5f_path = os.path.join(h5_override_dir, os.path.basename(train_h5f_path))
 
         # Prepare the datasets for trainging
-        dataset = prepare_dataset_h5(train_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, train_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files)
+        dataset = prepare_dataset_h5(train_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, train_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files, seq_codes=seq_codes)
         
         #prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1)
     
@@ -126,6 +279,9 @@ def train(config, args, checkpoint_dir=None):
     n_cont = len(dataset.cont_cols)
     
     #config['n_cont'] = n_cont
+    # local_hidden2_size 0 means local_hidden1_size//2 (resolved here, because search algorithms cannot use sample_from)
+    if config['local_hidden2_size'] == 0:
+        config['local_hidden2_size'] = config['local_hidden1_size']//2
     config['n_class'] = n_class
     config['model_no'] = model_no
     #config['bw_paths'] = bw_paths
@@ -138,11 +294,13 @@ def train(config, args, checkpoint_dir=None):
     if valid_file:
         print('using given validation file:', valid_file)
         valid_bed = BedTool(valid_file)
-        valid_h5f_path = get_h5f_path(valid_file, bw_names, config['distal_radius'], distal_order)
+        valid_h5f_path = get_h5f_path(valid_file, [] if seq_codes else bw_names, config['distal_radius'], distal_order, seq_codes)
+        if h5_override_dir:
+            valid_h5f_path = os.path.join(h5_override_dir, os.path.basename(valid_h5f_path))
         if without_h5:
-            dataset_valid = prepare_dataset_np(valid_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only)
+            dataset_valid = prepare_dataset_np(valid_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only, seq_codes_dict=seq_codes_dict)
         else:
-            dataset_valid = prepare_dataset_h5(valid_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, valid_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files)
+            dataset_valid = prepare_dataset_h5(valid_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, valid_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files, seq_codes=seq_codes)
         
         data_local_valid = dataset_valid.data_local
     ################
@@ -165,9 +323,14 @@ def train(config, args, checkpoint_dir=None):
         valid_size = int(len(dataset)*valid_ratio)
         train_size = len(dataset) - valid_size
     
-        # Split the data into two parts - training data and validation data
-        dataset_train, dataset_valid = random_split(dataset, [train_size, valid_size], torch.Generator().manual_seed(split_seed))
-        dataset_valid.indices.sort()
+        # Split the data into two parts - training data and validation data; the split shared 
+        # by all trials is used if it matches the dataset
+        split_indices = ray.get(split_handle) if split_handle is not None else None
+        if split_indices is None or len(split_indices[1]) != valid_size or len(split_indices[0]) != train_size:
+            split_indices = get_split_indices(len(dataset), valid_ratio, split_seed)
+        
+        dataset_train = Subset(dataset, split_indices[0])
+        dataset_valid = Subset(dataset, split_indices[1])
         #data_local_valid = dataset.data_local.iloc[dataset_valid.indices, :]
         data_local_valid = data_local.iloc[dataset_valid.indices, ].reset_index(drop=True)
     else:
@@ -176,21 +339,29 @@ def train(config, args, checkpoint_dir=None):
         valid_size = len(dataset_valid)
     
     print('train_size, valid_size:', train_size, valid_size)
-    # Dataloader for training
-    #if not ImbSampler: 
-    if not sample_weights:
-        dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=True, num_workers=cpu_per_trial-1, pin_memory=True)
-    else:
-        weights = pd.read_csv(sample_weights, sep='\t', header=None)
-        weights = weights[3]
-        weighted_sampler = WeightedRandomSampler(weights, len(weights), replacement=True)
-        
-        dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=False, sampler=weighted_sampler, num_workers=cpu_per_trial-1, pin_memory=True)
-        #dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=False, sampler=ImbalancedDatasetSampler(dataset_train), num_workers=cpu_per_trial-1, pin_memory=True)
+    
+    # DataLoader settings; pinned host memory allows asynchronous copies to the GPU
+    pin_memory = not getattr(args, 'pin_memory_false', False) and device.type == 'cuda'
+    n_workers = getattr(args, 'dataloader_workers', -1)
+    if n_workers < 0:
+        n_workers = cpu_per_trial-1
+    loader_kwargs = {'num_workers': n_workers, 'pin_memory': pin_memory}
+    if n_workers > 0:
+        # Number of batches loaded in advance by each worker
+        loader_kwargs['prefetch_factor'] = getattr(args, 'prefetch_factor', 2)
+        # Keep the workers (and their open H5 files) across epochs
+        loader_kwargs['persistent_workers'] = True
+    
+    # Data-parallel training if the trial is run by multiple workers (see '--workers_per_trial')
+    distributed = dist.is_available() and dist.is_initialized()
+    world_size = dist.get_world_size() if distributed else 1
+    rank = dist.get_rank() if distributed else 0
+    train_sampler = None
+    sampler_generator = None
     
     # Dataloader for predicting
-    dataloader_valid = DataLoader(dataset_valid, config['batch_size'], shuffle=False, num_workers=0, pin_memory=True)
-
+    dataloader_valid = DataLoader(dataset_valid, config['batch_size'], shuffle=False, num_workers=0, pin_memory=pin_memory)
+    
     if config['transfer_learning']:
         emb_dims = config['emb_dims']
     else:
@@ -209,11 +380,11 @@ def train(config, args, checkpoint_dir=None):
 
     elif model_no == 1:
         # ResNet model
-        model = Network1(in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'],  distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class)
+        model = Network1(in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'],  distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class, share_distal_cnn=config.get('share_distal_cnn', False))
 
     elif model_no == 2:
         # Combined model
-        model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[config['local_hidden1_size'], config['local_hidden2_size']], emb_dropout=config['emb_dropout'], lin_layer_dropouts=[config['local_dropout'], config['local_dropout']], in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'], distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class, emb_padding_idx=4**config['local_order'])
+        model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[config['local_hidden1_size'], config['local_hidden2_size']], emb_dropout=config['emb_dropout'], lin_layer_dropouts=[config['local_dropout'], config['local_dropout']], in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'], distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class, emb_padding_idx=4**config['local_order'], share_distal_cnn=config.get('share_distal_cnn', False))
     else:
         print('Error: no model selected!')
         sys.exit() 
@@ -286,18 +457,83 @@ def train(config, args, checkpoint_dir=None):
         print("NOTE: rewriting config['weight_decay'], new weight_decay: ", config['weight_decay'])
     
     # Set Optimizer
-    if config['optim'] == 'Adam':
-        optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=config['learning_rate'], weight_decay=config['weight_decay'])
-
-    elif config['optim'] == 'AdamW':
-        optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=config['learning_rate'], weight_decay=config['weight_decay'])
-        
-    elif config['optim'] == 'SGD':
-        optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=config['learning_rate'], weight_decay=config['weight_decay'], momentum=0.98, nesterov=True)
-     
-    else:
+    optimizer = get_optimizer(config['optim'], filter(lambda p: p.requires_grad, model.parameters()), config['learning_rate'], config['weight_decay'], device)
+    
+    if optimizer is None:
         print('Error: unsupported optimization method', config['optim'])
         sys.exit()
+    
+    # Model used for the forward pass in training; gradients are all-reduced across workers if distributed
+    train_model = model
+    if distributed:
+        train_model = DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None, gradient_as_bucket_view=True)
+        print('using DistributedDataParallel, world_size:', world_size)
+    
+    # Whether the training model is compiled; then the last incomplete batch is dropped to keep shapes fixed
+    model_compiled = False
+    if compile_model != 'none':
+        if hasattr(torch, 'compile'):
+            # Ray may run several trials (with different model shapes) in the same worker process
+            if hasattr(torch, '_dynamo'):
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            
+            # Shapes are fixed (drop_last=True), so CUDA graphs can be used; DDP needs graph breaks at gradient buckets
+            train_model = torch.compile(train_model, mode=compile_model, fullgraph=not distributed, dynamic=False)
+            print('using torch.compile for training, mode:', compile_model)
+            model_compiled = True
+        else:
+            print('Warning: torch.compile is not available in this PyTorch version; --compile_model is ignored.')
+    
+    # Mixed precision for the forward pass and loss; fp16 needs gradient scaling to avoid underflow
+    amp_dtype = None
+    if amp == 'bf16':
+        amp_dtype = torch.bfloat16
+    elif amp == 'fp16':
+        if device.type == 'cuda':
+            amp_dtype = torch.float16
+        else:
+            print('Warning: fp16 mixed precision requires CUDA; --amp fp16 is ignored.')
+    scaler = torch.cuda.amp.GradScaler(enabled=(amp_dtype == torch.float16))
+    
+    # With --auto_batch_size, use smaller training batches if a batch does not fit in the GPU memory (or 
+    # the share of the trial), and accumulate the gradients of accum_steps batches per optimizer step
+    train_batch_size = config['batch_size']
+    accum_steps = 1
+    if auto_batch_size:
+        if device.type == 'cuda' and not distributed:
+            probe_batch = next(iter(DataLoader(dataset_train, config['batch_size'], shuffle=False)))
+            mem_fraction = gpu_per_trial if 0 < gpu_per_trial < 1 else 1.0
+            train_batch_size, accum_steps = find_max_batch_size(model, criterion, probe_batch, device, amp_dtype, mem_fraction)
+            del probe_batch
+            print('NOTE: training batch size:', train_batch_size, ', gradient accumulation steps:', accum_steps)
+        else:
+            print('Warning: --auto_batch_size requires a single CUDA device per trial; it is ignored.')
+    
+    # Dataloader for training
+    #if not ImbSampler: 
+    if not sample_weights:
+        if distributed:
+            # Each worker gets a different shard of the training data
+            train_sampler = DistributedSampler(dataset_train, shuffle=True)
+            dataloader_train = DataLoader(dataset_train, train_batch_size, shuffle=False, sampler=train_sampler, drop_last=model_compiled, **loader_kwargs)
+        else:
+            dataloader_train = DataLoader(dataset_train, train_batch_size, shuffle=True, drop_last=model_compiled, **loader_kwargs)
+    else:
+        weights = pd.read_csv(sample_weights, sep='\t', header=None)
+        weights = weights[3]
+        # Each worker draws its share of the samples with its own generator, re-seeded every epoch
+        if distributed:
+            sampler_generator = torch.Generator()
+        weighted_sampler = WeightedRandomSampler(weights, len(weights)//world_size, replacement=True, generator=sampler_generator)
+        
+        dataloader_train = DataLoader(dataset_train, train_batch_size, shuffle=False, sampler=weighted_sampler, drop_last=model_compiled, **loader_kwargs)
+        #dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=False, sampler=ImbalancedDatasetSampler(dataset_train), num_workers=cpu_per_trial-1, pin_memory=True)
+    
+    # Overlap the H2D copy of the next training batch with computation (not combined with DDP)
+    if device.type == 'cuda' and not distributed:
+        batches_train = CUDAPrefetcher(dataloader_train, device)
+    else:
+        batches_train = dataloader_train
 
 
     #scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=config['LR_gamma'])
@@ -322,26 +558,43 @@ def train(config, args, checkpoint_dir=None):
 
         model.train()
         total_loss = 0
-
-        for y, cont_x, cat_x, distal_x in dataloader_train:
-            cat_x = cat_x.to(device)
-            cont_x = cont_x.to(device)
-            distal_x = distal_x.to(device)
-            y  = y.to(device)
+        
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        if sampler_generator is not None:
+            sampler_generator.manual_seed(split_seed + epoch*world_size + rank)
+
+        n_batches = len(batches_train)
+        for i, (y, cont_x, cat_x, distal_x) in enumerate(batches_train):
+            cat_x = cat_x.to(device, non_blocking=True)
+            cont_x = cont_x.to(device, non_blocking=True)
+            distal_x = distal_x.to(device, non_blocking=True)
+            y  = y.to(device, non_blocking=True)
+            
+            if distal_x.dtype == torch.uint8:
+                distal_x = expand_seq_codes(distal_x)
 
 
             # Forward Pass
-            preds = model.forward((cont_x, cat_x), distal_x)
-            loss = criterion(preds, y.long().squeeze())
-                   
-            optimizer.zero_grad()
-            loss.backward()
+            with autocast_context(device.type, amp_dtype):
+                preds = train_model((cont_x, cat_x), distal_x)
+                loss = criterion(preds, y.long().squeeze())
+            
+            # The loss is summed over samples, so accumulated gradients need no rescaling
+            if i % accum_steps == 0:
+                optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            total_loss += loss.item()
+            
+            if (i+1) % accum_steps != 0 and i+1 != n_batches:
+                continue
             
-            #Clips gradient norm to avoid exploding gradients
+            #Clips gradient norm to avoid exploding gradients (on unscaled gradients)
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10, error_if_nonfinite=False)
             
-            optimizer.step()
-            total_loss += loss.item()
+            scaler.step(optimizer)
+            scaler.update()
             
             if config['lr_scheduler'] != 'ROP':
                 scheduler.step()
@@ -352,6 +605,12 @@ def train(config, args, checkpoint_dir=None):
                         g['lr'] = config['restart_lr']
                         #scheduler.step(1)
         
+        if distributed:
+            # Sum up the training loss over all workers
+            total_loss_sum = torch.tensor([total_loss], device=device)
+            dist.all_reduce(total_loss_sum)
+            total_loss = total_loss_sum.item()
+        
         # Flush StdOut buffer
         sys.stdout.flush()
         
@@ -360,144 +619,154 @@ def train(config, args, checkpoint_dir=None):
         #scheduler.step()
         
         model.eval()
-        with torch.no_grad():
-            if model_no != 0:
-                print('model.conv1[0].weight:', model.conv1[0].weight)
-                print('model.conv1[0].weight.grad:', model.conv1[0].weight.grad)
-            #print('model.conv1.0.weight.grad:', model.conv1.0.weight)
+        # Only the first worker evaluates the model if distributed; the others receive its metrics
+        if rank == 0:
+            with torch.no_grad():
+                if model_no != 0:
+                    print('model.conv1[0].weight:', model.conv1[0].weight)
+                    print('model.conv1[0].weight.grad:', model.conv1[0].weight.grad)
+                #print('model.conv1.0.weight.grad:', model.conv1.0.weight)
 
-            valid_pred_y, valid_total_loss = model_predict_m(model, dataloader_valid, criterion, device, n_class, distal=True)
+                valid_pred_y, valid_total_loss = model_predict_m(model, dataloader_valid, criterion, device, n_class, distal=True)
 
-            valid_y_prob = pd.DataFrame(data=to_np(F.softmax(valid_pred_y, dim=1)), columns=prob_names)
+                valid_y_prob = pd.DataFrame(data=to_np(F.softmax(valid_pred_y, dim=1)), columns=prob_names)
             
-            if not valid_file:
-                valid_data_and_prob = pd.concat([data_local.iloc[dataset_valid.indices, ].reset_index(drop=True), valid_y_prob], axis=1)
+                if not valid_file:
+                    valid_data_and_prob = pd.concat([data_local.iloc[dataset_valid.indices, ].reset_index(drop=True), valid_y_prob], axis=1)
                 
-            else:
-                valid_data_and_prob = pd.concat([data_local_valid, valid_y_prob], axis=1)
+                else:
+                    valid_data_and_prob = pd.concat([data_local_valid, valid_y_prob], axis=1)
             
-            valid_y = valid_data_and_prob['mut_type'].to_numpy().squeeze()
+                valid_y = valid_data_and_prob['mut_type'].to_numpy().squeeze()
             
-            # Train the calibrator using the validataion data
-            #valid_y_prob = valid_y_prob.reset_index() #### for "ValueError: Input contains NaN"
+                # Train the calibrator using the validataion data
+                #valid_y_prob = valid_y_prob.reset_index() #### for "ValueError: Input contains NaN"
 
-            fdiri_cal, fdiri_nll = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='FullDiri')
-            #fdirio_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='FullDiriODIR')
-            #vec_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='VectS')
-            #tmp_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='TempS')
+                fdiri_cal, fdiri_nll = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='FullDiri')
+                #fdirio_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='FullDiriODIR')
+                #vec_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='VectS')
+                #tmp_cal, _ = calibrate_prob(valid_y_prob.to_numpy(), valid_y, device, calibr_name='TempS')
             
-            print("valid_data_and_prob.iloc[0:10]", valid_data_and_prob.iloc[0:10])
+                print("valid_data_and_prob.iloc[0:10]", valid_data_and_prob.iloc[0:10])
             
-            # Compare observed/predicted 3/5/7mer mutation frequencies
-            print('3mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 3, n_class))
-            print('5mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 5, n_class))
-            print('7mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 7, n_class))
+                # Compare observed/predicted 3/5/7mer mutation frequencies
+                print('3mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 3, n_class))
+                print('5mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 5, n_class))
+                print('7mer correlation - all: ', freq_kmer_comp_multi(valid_data_and_prob, 7, n_class))
             
-            print ('Training Loss: ', total_loss/train_size)
+                print ('Training Loss: ', total_loss/train_size)
             
-            print ('Validation Loss: ', valid_total_loss/valid_size)
-            print ('Validation Loss (after fdiri_cal): ', fdiri_nll)
+                print ('Validation Loss: ', valid_total_loss/valid_size)
+                print ('Validation Loss (after fdiri_cal): ', fdiri_nll)
             
-            ###########
-            prob_cal = fdiri_cal.predict_proba(valid_y_prob.to_numpy())  
-            y_prob = pd.DataFrame(data=np.copy(prob_cal), columns=prob_names)
-    
-            # Combine data and do k-mer evaluation
-            valid_cal_data_and_prob = pd.concat([data_local_valid, y_prob], axis=1)         
-            print('3mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 3, n_class))
-            print('5mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 5, n_class))
-            print('7mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 7, n_class))
-            ############      
+                ###########
+                prob_cal = fdiri_cal.predict_proba(valid_y_prob.to_numpy())  
+                y_prob = pd.DataFrame(data=np.copy(prob_cal), columns=prob_names)
+    
+                # Combine data and do k-mer evaluation
+                valid_cal_data_and_prob = pd.concat([data_local_valid, y_prob], axis=1)         
+                print('3mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 3, n_class))
+                print('5mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 5, n_class))
+                print('7mer correlation(after fdiri_cal): ', freq_kmer_comp_multi(valid_cal_data_and_prob, 7, n_class))
+                ############      
             
-            # Calculate a custom score by looking obs/pred 3/5-mer correlations in binned windows
-            if valid_size > 10000 *10:
-                region_size = 10000
-            else:
-                region_size = valid_size // 10
+                # Calculate a custom score by looking obs/pred 3/5-mer correlations in binned windows
+                if valid_size > 10000 *10:
+                    region_size = 10000
+                else:
+                    region_size = valid_size // 10
             
-            n_regions = valid_size//region_size
-            print('n_regions:', n_regions)
+                n_regions = valid_size//region_size
+                print('n_regions:', n_regions)
             
-            score = 0
-            corr_3mer = []
-            corr_5mer = []
+                score = 0
+                corr_3mer = []
+                corr_5mer = []
             
-            region_avg = []
-            for i in range(n_regions):
-                corr_3mer = freq_kmer_comp_multi(valid_data_and_prob.iloc[region_size*i:region_size*(i+1), ], 3, n_class)    
-                corr_5mer = freq_kmer_comp_multi(valid_data_and_prob.iloc[region_size*i:region_size*(i+1), ], 5, n_class)
+                region_avg = []
+                for i in range(n_regions):
+                    corr_3mer = freq_kmer_comp_multi(valid_data_and_prob.iloc[region_size*i:region_size*(i+1), ], 3, n_class)    
+                    corr_5mer = freq_kmer_comp_multi(valid_data_and_prob.iloc[region_size*i:region_size*(i+1), ], 5, n_class)
                 
-                score += np.sum([(1-corr)**2 for corr in corr_3mer]) + np.sum([(1-corr)**2 for corr in corr_5mer])
+                    score += np.sum([(1-corr)**2 for corr in corr_3mer]) + np.sum([(1-corr)**2 for corr in corr_5mer])
                 
-                avg_prob = calc_avg_prob(valid_data_and_prob.iloc[region_size*i:region_size*(i+1)], n_class)
-                region_avg.append(avg_prob)
-                #print("avg_prob:", avg_prob, i)
+                    avg_prob = calc_avg_prob(valid_data_and_prob.iloc[region_size*i:region_size*(i+1)], n_class)
+                    region_avg.append(avg_prob)
+                    #print("avg_prob:", avg_prob, i)
             
-            region_avg = pd.DataFrame(region_avg)
-            #print('region_avg.head():', region_avg.head())
-            corr_list = []
-            for i in range(n_class):
-                corr_list.append(region_avg[i].corr(region_avg[i + n_class]))
+                region_avg = pd.DataFrame(region_avg)
+                #print('region_avg.head():', region_avg.head())
+                corr_list = []
+                for i in range(n_class):
+                    corr_list.append(region_avg[i].corr(region_avg[i + n_class]))
             
-            print('corr_list:', corr_list)
-            #print('corr_3mer:', corr_3mer)
-            #print('corr_5mer:', corr_5mer)
-            print('regional score:', score, n_regions)
+                print('corr_list:', corr_list)
+                #print('corr_3mer:', corr_3mer)
+                #print('corr_5mer:', corr_5mer)
+                print('regional score:', score, n_regions)
             
-            # Output genomic positions and predicted probabilities
-            if not valid_file:
-                chr_pos = train_bed.to_dataframe().loc[dataset_valid.indices,['chrom', 'start', 'end', 'strand']].reset_index(drop=True)
-            else:
-                chr_pos = valid_bed.to_dataframe()[['chrom', 'start', 'end', 'strand']]
+                # Output genomic positions and predicted probabilities
+                if not valid_file:
+                    chr_pos = train_bed.to_dataframe().loc[dataset_valid.indices,['chrom', 'start', 'end', 'strand']].reset_index(drop=True)
+                else:
+                    chr_pos = valid_bed.to_dataframe()[['chrom', 'start', 'end', 'strand']]
                 
-            valid_pred_df = pd.concat((chr_pos, valid_data_and_prob[['mut_type'] + prob_names]), axis=1)
-            valid_pred_df.columns = ['chrom', 'start', 'end', 'strand', 'mut_type'] + prob_names
-            ####
-            valid_cal_pred_df = pd.concat((chr_pos, valid_cal_data_and_prob[['mut_type'] + prob_names]), axis=1)
-            valid_cal_pred_df.columns = ['chrom', 'start', 'end', 'strand', 'mut_type'] + prob_names
+                valid_pred_df = pd.concat((chr_pos, valid_data_and_prob[['mut_type'] + prob_names]), axis=1)
+                valid_pred_df.columns = ['chrom', 'start', 'end', 'strand', 'mut_type'] + prob_names
+                ####
+                valid_cal_pred_df = pd.concat((chr_pos, valid_cal_data_and_prob[['mut_type'] + prob_names]), axis=1)
+                valid_cal_pred_df.columns = ['chrom', 'start', 'end', 'strand', 'mut_type'] + prob_names
             
-            ####
+                ####
             
-            print('valid_pred_df: ', valid_pred_df.head())
+                print('valid_pred_df: ', valid_pred_df.head())
             
-            # Save model data for each checkpoint
-            with tune.checkpoint_dir(epoch) as checkpoint_dir:
-                path = os.path.join(checkpoint_dir, 'model')
-                torch.save(model.state_dict(), path)
+                # Save model data for each checkpoint (only by the first worker if distributed)
+                with (distributed_checkpoint_dir(step=epoch) if distributed else tune.checkpoint_dir(epoch)) as checkpoint_dir:
+                    path = os.path.join(checkpoint_dir, 'model')
+                    torch.save(model.state_dict(), path)
             
-                with open(path + '.fdiri_cal.pkl', 'wb') as pkl_file:
-                    pickle.dump(fdiri_cal, pkl_file)
+                    with open(path + '.fdiri_cal.pkl', 'wb') as pkl_file:
+                        pickle.dump(fdiri_cal, pkl_file)
                 
-                with open(path + '.config.pkl', 'wb') as fp:
-                    pickle.dump(config, fp)
-                if save_valid_preds:
-                    valid_pred_df.to_csv(path + '.valid_preds.tsv.gz', sep='\t', float_format='%.4g', index=False)
+                    with open(path + '.config.pkl', 'wb') as fp:
+                        pickle.dump(config, fp)
+                    if save_valid_preds:
+                        valid_pred_df.to_csv(path + '.valid_preds.tsv.gz', sep='\t', float_format='%.4g', index=False)
                     
-            # Print regional correlations
-            valid_pred_df.sort_values(['chrom', 'start'], inplace=True)
-            valid_cal_pred_df.sort_values(['chrom', 'start'], inplace=True)
-            #for win_size in [20000, 100000, 500000]:
-            for win_size in [100000, 500000]:
+                # Print regional correlations
+                valid_pred_df.sort_values(['chrom', 'start'], inplace=True)
+                valid_cal_pred_df.sort_values(['chrom', 'start'], inplace=True)
+                #for win_size in [20000, 100000, 500000]:
+                for win_size in [100000, 500000]:
                 
-                corr_win = corr_calc_sub(valid_pred_df, win_size, prob_names)
-                print('regional corr (validation):', str(win_size)+'bp', corr_win)
+                    corr_win = corr_calc_sub(valid_pred_df, win_size, prob_names)
+                    print('regional corr (validation):', str(win_size)+'bp', corr_win)
                 
-                corr_win_cal = corr_calc_sub(valid_cal_pred_df, win_size, prob_names)
-                print('regional corr (validation, after calibration):', str(win_size)+'bp', corr_win_cal)
+                    corr_win_cal = corr_calc_sub(valid_cal_pred_df, win_size, prob_names)
+                    print('regional corr (validation, after calibration):', str(win_size)+'bp', corr_win_cal)
                     
-            current_loss = valid_total_loss/valid_size
-            if epoch == 0 or current_loss < min_loss:
-                min_loss = current_loss
-                min_loss_epoch = epoch
-                after_min_loss = 0
-            else:
-                after_min_loss = epoch - min_loss_epoch
+                current_loss = valid_total_loss/valid_size
+                if epoch == 0 or current_loss < min_loss:
+                    min_loss = current_loss
+                    min_loss_epoch = epoch
+                    after_min_loss = 0
+                else:
+                    after_min_loss = epoch - min_loss_epoch
                 
-            tune.report(loss=current_loss, fdiri_loss=fdiri_nll, after_min_loss=after_min_loss, score=score, total_params=total_params)
-            
-            #####
-            if config['lr_scheduler'] == 'ROP':
-                scheduler.step(current_loss)
-            
-            torch.cuda.empty_cache() 
-            sys.stdout.flush()
+                metrics = [current_loss, fdiri_nll, score, after_min_loss]
+        
+        if distributed:
+            if rank != 0:
+                metrics = [None]*4
+            dist.broadcast_object_list(metrics, src=0)
+            current_loss, fdiri_nll, score, after_min_loss = metrics
+        
+        tune.report(loss=current_loss, fdiri_loss=fdiri_nll, after_min_loss=after_min_loss, score=score, total_params=total_params)
+        
+        #####
+        if config['lr_scheduler'] == 'ROP':
+            scheduler.step(current_loss)
+        
+        torch.cuda.empty_cache() 
+        sys.stdout.flush()
@@ -0,0 +1,112 @@
+"""
+Check that the inference-only rewrites of the models (BatchNorm folding,
+to_inference()) give the same outputs as the original layers
+"""
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+nn_models = pytest.importorskip('MuRaL.nn_models')
+
+import torch.nn as nn
+
+
+def randomize_bn(model, seed=0):
+    """Give the BatchNorm layers non-trivial statistics and affine parameters"""
+    g = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm1d):
+                n = m.num_features
+                m.running_mean.copy_(torch.randn(n, generator=g))
+                m.running_var.copy_(torch.rand(n, generator=g) + 0.5)
+                if m.affine:
+                    m.weight.copy_(torch.randn(n, generator=g))
+                    m.bias.copy_(torch.randn(n, generator=g))
+
+    return model
+
+def make_network2(distal_radius=150, n_cont=2, local_radius=5, share_distal_cnn=False):
+    n_cat = 2*local_radius + 1
+    model = nn_models.Network2(emb_dims=[(5, 3)]*n_cat, no_of_cont=n_cont, lin_layer_sizes=[20, 10], emb_dropout=0.1, lin_layer_dropouts=[0.1, 0.1], in_channels=4, out_channels=8, kernel_size=3, distal_radius=distal_radius, distal_order=1, distal_fc_dropout=0.1, n_class=4, emb_padding_idx=4, share_distal_cnn=share_distal_cnn)
+
+    return randomize_bn(model)
+
+def make_inputs(batch_size=6, distal_radius=150, n_cont=2, local_radius=5):
+    g = torch.Generator().manual_seed(1)
+    cont_x = torch.randn(batch_size, n_cont, generator=g)
+    cat_x = torch.randint(0, 5, (batch_size, 2*local_radius + 1), generator=g)
+    distal_x = torch.randn(batch_size, 4, 2*distal_radius + 1, generator=g)
+
+    return (cont_x, cat_x), distal_x
+
+
+def test_bn_scale_shift():
+    bn = randomize_bn(nn.BatchNorm1d(6)).eval()
+    x = torch.randn(4, 6, 9)
+    scale, shift = nn_models.bn_scale_shift(bn)
+
+    assert torch.allclose(bn(x), x*scale.view(1, -1, 1) + shift.view(1, -1, 1), atol=1e-5)
+
+def test_fuse_conv_bn():
+    layers = randomize_bn(nn.Sequential(nn.Conv1d(4, 6, 5, padding=2), nn.BatchNorm1d(6))).eval()
+    x = torch.randn(3, 4, 20)
+
+    fused = nn_models.fuse_bn_conv_layers(layers)
+    assert not any(isinstance(m, nn.BatchNorm1d) for m in fused.modules())
+
+    with torch.no_grad():
+        assert torch.allclose(layers(x), fused(x), atol=1e-5)
+
+@pytest.mark.parametrize('padding, dilation', [(0, 1), (2, 1), (4, 2)])
+def test_fused_bn_conv1d(padding, dilation):
+    layers = randomize_bn(nn.Sequential(nn.BatchNorm1d(4), nn.Conv1d(4, 6, 5, padding=padding, dilation=dilation))).eval()
+    x = torch.randn(3, 4, 20)
+
+    fused = nn_models.fuse_bn_conv_layers(layers)
+    assert isinstance(fused[0], nn_models.FusedBNConv1d)
+
+    # The zero-padded edges are where folding the BN shift into the bias is not exact
+    with torch.no_grad():
+        assert torch.allclose(layers(x), fused(x), atol=1e-5)
+
+def test_fused_bn_conv1d_short_input():
+    layers = randomize_bn(nn.Sequential(nn.BatchNorm1d(4), nn.Conv1d(4, 6, 5, padding=2))).eval()
+    x = torch.randn(2, 4, 3)
+
+    fused = nn_models.fuse_bn_conv_layers(layers)
+    with torch.no_grad():
+        assert torch.allclose(layers(x), fused(x), atol=1e-5)
+
+@pytest.mark.parametrize('share_distal_cnn', [False, True])
+def test_network2_to_inference(share_distal_cnn):
+    model = make_network2(share_distal_cnn=share_distal_cnn).eval()
+    local_x, distal_x = make_inputs()
+
+    fused = nn_models.to_inference(copy.deepcopy(model))
+    assert not any(isinstance(m, nn.Dropout) for m in fused.modules())
+
+    with torch.no_grad():
+        assert torch.allclose(model(local_x, distal_x), fused(local_x, distal_x), atol=1e-4)
+
+def test_feedforward_to_inference():
+    model = randomize_bn(nn_models.FeedForwardNN(emb_dims=[(5, 3)]*11, no_of_cont=2, lin_layer_sizes=[20, 10], emb_dropout=0.1, lin_layer_dropouts=[0.1, 0.1], n_class=4, emb_padding_idx=4)).eval()
+    (cont_x, cat_x), _ = make_inputs()
+
+    fused = nn_models.to_inference(copy.deepcopy(model))
+    with torch.no_grad():
+        assert torch.allclose(model(cont_x, cat_x), fused(cont_x, cat_x), atol=1e-5)
+
+def test_positional_encoding_loads_old_checkpoints():
+    pe = nn_models.PositionalEncoding(d_model=8, max_len=10)
+    assert 'pe' not in pe.state_dict()
+
+    # Older checkpoints saved pe with shape (max_len, 1, d_model)
+    pe.load_state_dict({'pe': torch.zeros(10, 1, 8)})
+    assert pe.pe.abs().sum() > 0
+
+def test_mutransformer_post_norm_by_default():
+    model = nn_models.MuTransformer(4, 8, 3, 150, 1, 0.1, 4, nhead=2, dim_feedforward=16, trans_dropout=0.1, num_layers=1)
+
+    assert not model.transformer_encoder.layers[0].norm_first
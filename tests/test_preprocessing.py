@@ -0,0 +1,125 @@
+"""
+Check the vectorized extraction of local and distal sequences against the
+per-site loops they replaced
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+preprocessing = pytest.importorskip('MuRaL.preprocessing')
+
+
+DIGIT_ENCODER = dict(zip('ACGT', range(4)))
+DIGIT_ENCODER_RC = dict(zip('TGCA', range(4)))
+
+def ref_windows(genome, sites, radius):
+    """Windows of the sites as strings, padded with N at the chromosome ends, as in the original loop"""
+    seq_len = 2*radius + 1
+    windows = []
+    for chrom, start, stop, strand in sites[['chrom', 'start', 'end', 'strand']].itertuples(index=False):
+        long_seq = genome[chrom]
+        start1 = max(start-radius, 0)
+        stop1 = min(stop+radius, len(long_seq))
+        short_seq = long_seq[start1:stop1].upper()
+
+        if len(short_seq) < seq_len:
+            if start1 == 0:
+                short_seq = (seq_len - len(short_seq))*'N' + short_seq
+            else:
+                short_seq = short_seq + (seq_len - len(short_seq))*'N'
+        windows.append((short_seq, strand))
+
+    return windows
+
+def ref_digitalized_seq(genome, sites, radius, order):
+    digit_seqs = []
+    for short_seq, strand in ref_windows(genome, sites, radius):
+        if strand == '+':
+            digit_seq = [DIGIT_ENCODER.get(c, -1) for c in short_seq]
+        else:
+            digit_seq = [DIGIT_ENCODER_RC.get(c, -1) for c in short_seq[::-1]]
+
+        if order > 1:
+            new_seq = []
+            for i in range(len(digit_seq) - order + 1):
+                kmer = digit_seq[i:i+order]
+                if min(kmer) < 0:
+                    new_seq.append(-1)
+                else:
+                    new_seq.append(sum([kmer[d]*4**(order-d-1) for d in range(order)]))
+            digit_seq = new_seq
+        digit_seqs.append(digit_seq)
+
+    return np.array(digit_seqs)
+
+def ref_digitalized_seq_ohe(genome, sites, radius):
+    codes = preprocessing.SEQ_CODES
+    ohe = preprocessing.SEQ_CODE_OHE
+    ohe_rc = preprocessing.SEQ_CODE_OHE_RC
+
+    distal_seqs = []
+    for short_seq, strand in ref_windows(genome, sites, radius):
+        if strand == '+':
+            distal_seq = np.stack([ohe[codes.index(c)] for c in short_seq], axis=1)
+        else:
+            distal_seq = np.stack([ohe_rc[codes.index(c)] for c in short_seq[::-1]], axis=1)
+        distal_seqs.append(distal_seq)
+
+    return np.array(distal_seqs)
+
+
+@pytest.fixture(scope='module')
+def genome():
+    rng = np.random.RandomState(0)
+    bases = list('ACGT')*6 + list('acgtRYN')
+    return {'chr1': ''.join(rng.choice(bases, 80)), 'chr2': ''.join(rng.choice(bases, 45))}
+
+@pytest.fixture(scope='module')
+def seq_codes_dict(genome, tmp_path_factory):
+    fasta = tmp_path_factory.mktemp('ref') / 'ref.fa'
+    fasta.write_text(''.join('>' + chrom + '\n' + seq + '\n' for chrom, seq in genome.items()))
+
+    return preprocessing.get_seq_codes_dict(str(fasta))
+
+@pytest.fixture(scope='module')
+def sites(genome):
+    # Sites at and near both chromosome ends, on both strands and interleaved chromosomes
+    rows = []
+    for i, start in enumerate([0, 3, 10, 20, 40, 70, 77, 79]):
+        rows.append(('chr1', start, start+1, '+-'[i % 2]))
+    for i, start in enumerate([0, 12, 30, 44]):
+        rows.append(('chr2', start, start+1, '-+'[i % 2]))
+    rows = [rows[i] for i in np.random.RandomState(1).permutation(len(rows))]
+
+    return pd.DataFrame(rows, columns=['chrom', 'start', 'end', 'strand'])
+
+
+def test_get_seq_codes_dict(genome, seq_codes_dict):
+    for chrom, seq in genome.items():
+        assert ''.join(preprocessing.SEQ_CODES[c] for c in seq_codes_dict[chrom]) == seq.upper()
+
+@pytest.mark.parametrize('radius', [5, 10])
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_get_digitalized_seq(genome, seq_codes_dict, sites, radius, order):
+    digit_seqs = preprocessing.get_digitalized_seq(None, sites, radius, order, seq_codes_dict=seq_codes_dict)
+
+    assert digit_seqs.dtype == np.int32
+    np.testing.assert_array_equal(digit_seqs, ref_digitalized_seq(genome, sites, radius, order))
+
+@pytest.mark.parametrize('radius', [5, 10])
+def test_get_digitalized_seq_ohe(genome, seq_codes_dict, sites, radius):
+    distal_seqs = preprocessing.get_digitalized_seq_ohe(seq_codes_dict, sites, radius)
+
+    np.testing.assert_allclose(distal_seqs, ref_digitalized_seq_ohe(genome, sites, radius), atol=1e-7)
+
+def test_get_digitalized_seq_codes(genome, seq_codes_dict, sites):
+    seq_codes = preprocessing.get_digitalized_seq_codes(seq_codes_dict, sites, 10)
+    ohe = preprocessing.SEQ_CODE_OHE[seq_codes].transpose(0, 2, 1)
+
+    assert seq_codes.dtype == np.uint8
+    np.testing.assert_allclose(ohe, ref_digitalized_seq_ohe(genome, sites, 10), atol=1e-7)
+
+def test_get_seq_code_windows_empty(seq_codes_dict, sites):
+    windows = preprocessing.get_seq_code_windows(seq_codes_dict, sites.iloc[:0], 5)
+
+    assert windows.shape == (0, 11)
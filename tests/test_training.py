@@ -0,0 +1,83 @@
+"""
+Tests of the training helpers: data splitting, search space size and the
+batch splitting used with --auto_batch_size
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+tune = pytest.importorskip('ray.tune')
+training = pytest.importorskip('MuRaL.training')
+
+import torch.nn as nn
+from torch.utils.data import random_split
+
+
+def make_network2():
+    return training.Network2(emb_dims=[(5, 3)]*11, no_of_cont=2, lin_layer_sizes=[20, 10], emb_dropout=0.1, lin_layer_dropouts=[0.1, 0.1], in_channels=4, out_channels=8, kernel_size=3, distal_radius=150, distal_order=1, distal_fc_dropout=0.1, n_class=4, emb_padding_idx=4)
+
+def make_batch(batch_size=8):
+    g = torch.Generator().manual_seed(1)
+    y = torch.randint(0, 4, (batch_size, 1), generator=g)
+    cont_x = torch.randn(batch_size, 2, generator=g)
+    cat_x = torch.randint(0, 5, (batch_size, 11), generator=g)
+    distal_x = torch.randn(batch_size, 4, 301, generator=g)
+
+    return [y, cont_x, cat_x, distal_x]
+
+
+@pytest.mark.parametrize('n_samples, valid_ratio, split_seed', [(100, 0.1, 42), (57, 0.25, 0), (10, 0.0, 1)])
+def test_get_split_indices(n_samples, valid_ratio, split_seed):
+    train_idx, valid_idx = training.get_split_indices(n_samples, valid_ratio, split_seed)
+
+    valid_size = int(n_samples*valid_ratio)
+    dataset_train, dataset_valid = random_split(range(n_samples), [n_samples-valid_size, valid_size], torch.Generator().manual_seed(split_seed))
+
+    assert list(train_idx) == list(dataset_train.indices)
+    assert list(valid_idx) == sorted(dataset_valid.indices)
+
+def test_get_grid_size():
+    assert training.get_grid_size({'a': tune.choice([1, 2]), 'b': tune.choice(['x', 'y', 'x']), 'c': 5}) == 4
+    assert training.get_grid_size({'a': training.tune_choice([1]), 'b': 5}) == 1
+    assert training.get_grid_size({'a': tune.choice([1, 2]), 'b': tune.uniform(0, 1)}) is None
+
+def test_unique_config_searcher():
+    searcher = training.UniqueConfigSearcher()
+    searcher.set_search_properties(None, None, {'a': tune.choice([1, 2, 3]), 'b': tune.choice(['x', 'y']), 'c': 5})
+
+    configs = [searcher.suggest(str(i)) for i in range(6)]
+    assert len({(config['a'], config['b']) for config in configs}) == 6
+    assert searcher.suggest('6') == training.Searcher.FINISHED
+
+def test_gradient_accumulation_matches_full_batch():
+    # The training loss is summed over samples, so the gradients of the parts add up to those of the full batch
+    model = make_network2().eval()
+    criterion = nn.CrossEntropyLoss(reduction='sum')
+    y, cont_x, cat_x, distal_x = make_batch()
+
+    criterion(model((cont_x, cat_x), distal_x), y.squeeze(1)).backward()
+    full_grads = [p.grad.clone() for p in model.parameters()]
+
+    model.zero_grad(set_to_none=True)
+    for i in range(0, y.size(0), 3):
+        criterion(model((cont_x[i:i+3], cat_x[i:i+3]), distal_x[i:i+3]), y[i:i+3].squeeze(1)).backward()
+
+    for full_grad, p in zip(full_grads, model.parameters()):
+        assert torch.allclose(full_grad, p.grad, atol=1e-4)
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+def test_find_max_batch_size():
+    device = torch.device('cuda')
+    model = make_network2().to(device)
+    criterion = nn.CrossEntropyLoss(reduction='sum')
+    batch = make_batch()
+    model_state = {key: value.clone() for key, value in model.state_dict().items()}
+
+    assert training.find_max_batch_size(model, criterion, batch, device) == (8, 1)
+
+    # No part fits in a tiny memory budget, so the batch is split down to single samples
+    assert training.find_max_batch_size(model, criterion, batch, device, mem_fraction=1e-12) == (1, 8)
+
+    # The probes must not change the model (e.g. the BatchNorm running statistics)
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, model_state[key])
+    assert all(p.grad is None for p in model.parameters())